@@ -1610,6 +1610,10 @@
    * See docs/ConfigEmbedding.md for details on how to use 'mc-apply.py'.
    */
   //#define CONFIGURATION_EMBEDDING
+  #if ENABLED(CONFIGURATION_EMBEDDING)
+    //#define CONFIGURATION_EMBEDDING_CODEC LZMA // Compression for 'mc.zip': BZIP2 (default), LZMA, DEFLATE, or HEATSHRINK
+    //#define CONFIGURATION_EMBEDDING_DELTA      // Embed only the options changed from the stock configuration
+  #endif
 
   // Add an optimized binary file transfer mode, initiated with 'M28 B1'
   //#define BINARY_FILE_TRANSFER
@@ -17,9 +17,14 @@
 
 from __future__ import print_function
 import argparse
-import textwrap
 import os
+import sys
 import zlib
+from pathlib import Path
+
+# The shared C array emitter in buildroot/share/PlatformIO/scripts
+sys.path.insert(0, str(Path(__file__).resolve().parents[7] / 'buildroot' / 'share' / 'PlatformIO' / 'scripts'))
+from carray import byte_lines, c_array, write_if_changed
 
 def deflate(data):
   return zlib.compress(data)
@@ -28,6 +33,7 @@ if __name__ == "__main__":
   parser = argparse.ArgumentParser(description='Converts a file into a packed C array for use as data')
   parser.add_argument("input")
   parser.add_argument("-d", "--deflate", action="store_true", help="Packs the data using the deflate algorithm")
+  parser.add_argument("-o", "--output", help="Writes the array to a file, only if changed, instead of to stdout")
   args = parser.parse_args()
 
   varname = os.path.splitext(os.path.basename(args.input))[0];
@@ -36,12 +42,9 @@ if __name__ == "__main__":
     data = in_file.read()
   if args.deflate:
     data = deflate(data)
-  data = bytearray(data)
-  data = list(map(lambda a: "0x" + format(a, '02x'), data))
-  nElements = len(data)
-  data = ', '.join(data)
-  data = textwrap.fill(data, 75, initial_indent = '  ', subsequent_indent = '  ')
-
-  print("const unsigned char " + varname + "[" + format(nElements) + "] PROGMEM = {")
-  print(data)
-  print("};")
+  text = c_array("const unsigned char " + varname + "[" + format(len(data)) + "] PROGMEM", byte_lines(data, 12))
+
+  if args.output:
+    write_if_changed(args.output, text)
+  else:
+    print(text, end='')
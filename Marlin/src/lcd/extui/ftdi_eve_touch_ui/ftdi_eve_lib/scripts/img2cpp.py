@@ -18,10 +18,14 @@
 from __future__ import print_function
 from PIL import Image
 import argparse
-import textwrap
 import os
 import sys
 import zlib
+from pathlib import Path
+
+# The shared C array emitter in buildroot/share/PlatformIO/scripts
+sys.path.insert(0, str(Path(__file__).resolve().parents[7] / 'buildroot' / 'share' / 'PlatformIO' / 'scripts'))
+from carray import byte_lines, c_array, write_if_changed
 
 class WriteSource:
   def __init__(self, mode):
@@ -76,27 +80,25 @@ class WriteSource:
     if self.mode in ["l1", "l2", "l3"]:
        self.finish_byte()
 
-  def write(self, varname, deflate):
+  def write(self, varname, deflate, output=None):
     print("Length of uncompressed data: ", len(self.values), file=sys.stderr)
     data = bytes(bytearray(self.values))
     if deflate:
       data = self.deflate(data)
       print("Length of data after compression: ", len(data), file=sys.stderr)
-    data = bytearray(data)
-    data = list(map(lambda a: "0x" + format(a, '02x'), data))
-    nElements = len(data)
-    data = ', '.join(data)
-    data = textwrap.fill(data, 75, initial_indent = '  ', subsequent_indent = '  ')
+    text = c_array("const unsigned char " + varname + "[" + format(len(data)) + "] PROGMEM", byte_lines(data, 12))
 
-    print("const unsigned char " + varname + "[" + format(nElements) + "] PROGMEM = {")
-    print(data)
-    print("};")
+    if output:
+      write_if_changed(output, text)
+    else:
+      print(text, end='')
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(description='Converts a bitmap into a C array')
   parser.add_argument("input")
   parser.add_argument("-d", "--deflate", action="store_true", help="Packs the data using the deflate algorithm")
   parser.add_argument("-m", "--mode", default="l1", help="Mode, can be l1, l2, l4, l8, rgb332 or rgb565")
+  parser.add_argument("-o", "--output", help="Writes the array to a file, only if changed, instead of to stdout")
   args = parser.parse_args()
 
   varname = os.path.splitext(os.path.basename(args.input))[0];
@@ -110,4 +112,4 @@ if __name__ == "__main__":
     for x in range(img.width):
       writer.add_pixel(img.getpixel((x,y)))
     writer.end_row(y)
-  writer.write(varname, args.deflate)
+  writer.write(varname, args.deflate, args.output)
@@ -10,10 +10,10 @@ if pioutil.is_pio_build():
     Import("env")
 
     mf = env["MARLIN_FEATURES"]
-    rxBuf = mf["RX_BUFFER_SIZE"] if "RX_BUFFER_SIZE" in mf else "0"
-    txBuf = mf["TX_BUFFER_SIZE"] if "TX_BUFFER_SIZE" in mf else "0"
+    rxBuf = mf.value("RX_BUFFER_SIZE", 0, int)
+    txBuf = mf.value("TX_BUFFER_SIZE", 0, int)
 
-    serialBuf = str(max(int(rxBuf), int(txBuf), 350))
+    serialBuf = str(max(rxBuf, txBuf, 350))
 
     build_flags = env.get('BUILD_FLAGS')
     build_flags.append("-DSERIAL_BUFFER_SIZE=" + serialBuf)
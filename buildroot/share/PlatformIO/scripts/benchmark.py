@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+#
+# benchmark.py
+#
+# Time the per-build work done by the Marlin PlatformIO scripts, without
+# PlatformIO or a cross toolchain. The scripts run against a stand-in for
+# the SCons env, the defines come from the pure-Python preprocessor, and
+# anything that writes files works on copies in a temporary folder.
+# Run this from the root of the Marlin repo.
+#
+# Usage: benchmark.py [-c CONFIG]... [-n REPEAT] [-k NAME]... [-o OUTFILE] [-b BASELINE] [-t PERCENT]
+#        benchmark.py --codecs [FILE]... [-c CONFIG]...
+#
+#   -c CONFIG    Use the Configuration.h, Configuration_adv.h and config.ini in
+#                the CONFIG folder (e.g., from the MarlinFirmware/Configurations
+#                repo). May be repeated. (Default: the config files in Marlin/)
+#   -n REPEAT    Number of timed runs of each benchmark. (Default: 5)
+#   -k NAME      Only run benchmarks whose name contains NAME. May be repeated.
+#   -o OUTFILE   Save the results as a JSON baseline.
+#   -b BASELINE  Compare with a saved baseline and exit with an error if any
+#   -t PERCENT   benchmark's median is more than PERCENT slower. (Default: 25)
+#   --codecs     Compare the size of the embedded 'mc.zip' (CONFIGURATION_EMBEDDING)
+#                with each CONFIGURATION_EMBEDDING_CODEC, for the given marlin_config.json
+#                files or those in .pio/build. Without any, one is made for each CONFIG.
+#
+# The load_features and common-dependencies benchmarks need the PlatformIO
+# Python package (for PackageSpec) and are skipped without it.
+#
+import os, sys, re, json, time, shlex, types, shutil, random, platform, tempfile, statistics, configparser
+import importlib.util
+from copy import deepcopy
+from pathlib import Path
+
+script_dir = Path(__file__).resolve().parent
+sys.path.insert(0, str(script_dir))
+
+################################################################################
+#
+# Stand-ins for the SCons env, project config, board config and file nodes
+#
+class FakeProjectConfig:
+
+    def __init__(self, env):
+        self.env = env
+        self.sections = { 'env:' + env['PIOENV']: env.options }
+        feat = configparser.RawConfigParser()
+        feat.optionxform = str
+        feat.read(Path(env['PROJECT_DIR'], 'ini', 'features.ini'))
+        if feat.has_section('features'):
+            self.sections['features'] = dict(feat.items('features'))
+
+    def get(self, section, option, default=None):
+        return self.sections.get(section, {}).get(option, default)
+
+    def items(self, section):
+        return list(self.sections.get(section, {}).items())
+
+    def set(self, section, option, value):
+        self.sections.setdefault(section, {})[option] = value
+
+class FakeBoardConfig(dict):
+
+    def get(self, key, default=None):
+        val = self
+        for part in key.split('.'):
+            if not isinstance(val, dict) or part not in val: return default
+            val = dict.get(val, part)
+        return val
+
+class FakeNode:
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.dir = types.SimpleNamespace(path=str(Path(path).parent))
+
+    def get_abspath(self):
+        return str(Path(self.path).resolve())
+
+class FakeEnv(dict):
+
+    def __init__(self, project_dir, build_dir, options=None, board=None):
+        super().__init__(
+            PIOENV='benchmark',
+            PROJECT_DIR=str(project_dir),
+            PROJECT_BUILD_DIR=str(build_dir),
+            PROJECT_PACKAGES_DIR=str(Path(build_dir, 'packages')),
+            BUILD_DIR=str(Path(build_dir, 'benchmark')),
+            PROGNAME='firmware',
+            PLATFORM=sys.platform,
+            ENV={ 'PATH': os.environ.get('PATH', '') },
+            BUILD_FLAGS=[],
+            CPPDEFINES=[],
+            LINKFLAGS=[]
+        )
+        self.options = { 'lib_deps': [], 'lib_ignore': [], 'build_flags': [], 'src_filter': [ '+<src/*>' ] }
+        self.options.update(options or {})
+        self.board = FakeBoardConfig(board or {})
+        self.config = FakeProjectConfig(self)
+        self.scripts, self.post_actions = [], []
+
+    def GetProjectOption(self, option, default=None):
+        val = self.config.get('env:' + self['PIOENV'], option, default)
+        if val is None: raise KeyError(option)
+        return val
+
+    def GetProjectOptions(self, as_dict=False):
+        items = self.config.items('env:' + self['PIOENV'])
+        return dict(items) if as_dict else items
+
+    def GetProjectConfig(self):
+        return self.config
+
+    def BoardConfig(self):
+        return self.board
+
+    def GetBuildType(self):
+        return 'release'
+
+    def IsIntegrationDump(self):
+        return False
+
+    def IsCleanTarget(self):
+        return False
+
+    def subst(self, text):
+        return re.sub(r'\$\{?(\w+)\}?', lambda m: str(self.get(m[1], m[0])), text)
+
+    def Replace(self, **kw):
+        self.update(kw)
+
+    def Append(self, **kw):
+        for key, val in kw.items():
+            self[key] = self.get(key, []) + list(val)
+
+    def AddMethod(self, fn, name=None):
+        setattr(self, name or fn.__name__, types.MethodType(fn, self))
+
+    def AddPostAction(self, target, action):
+        self.post_actions.append(action)
+
+    def SConscript(self, script, exports=None):
+        self.scripts.append(script)
+
+    def Execute(self, action):
+        return 0
+
+    def VerboseAction(self, cmd, msg):
+        return cmd
+
+    # Only the defines matter to the preprocessor
+    def ParseFlagsExtended(self, flags):
+        cppdefines, args = [], []
+        for flag in flags or []:
+            args += shlex.split(flag)
+        args = iter(args)
+        for arg in args:
+            if arg == '-D': arg = '-D' + next(args, '')
+            if arg.startswith('-D') and len(arg) > 2:
+                name, eq, value = arg[2:].partition('=')
+                cppdefines.append((name, value) if eq else name)
+        return { 'CPPDEFINES': cppdefines }
+
+    ParseFlags = ParseFlagsExtended
+
+#
+# Make 'from SCons.Script import DefaultEnvironment' give the fake env,
+# as used by pioutil.py and marlin.py
+#
+def install_fake_scons(env):
+    scons = types.ModuleType('SCons')
+    script = types.ModuleType('SCons.Script')
+    script.DefaultEnvironment = lambda: env
+    scons.Script = script
+    sys.modules['SCons'], sys.modules['SCons.Script'] = scons, script
+    for mod in ('pioutil', 'marlin'):
+        sys.modules.pop(mod, None)
+
+#
+# Run a PlatformIO extra script with the given exports, returning its globals
+#
+def run_script(name, env, **exports):
+    path = script_dir / name
+    exports['env'] = env
+    g = { '__file__': str(path), '__name__': path.stem }
+    g['Import'] = lambda *names: g.update({ n: exports[n] for n in names })
+    exec(compile(path.read_text(), str(path), 'exec'), g)
+    return g
+
+################################################################################
+#
+# Timing
+#
+def measure(repeat, fn, setup=None):
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        fn(arg) if setup else fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return {
+        'runs': repeat,
+        'min_ms': round(min(times), 3),
+        'median_ms': round(statistics.median(times), 3),
+        'mean_ms': round(statistics.mean(times), 3)
+    }
+
+################################################################################
+#
+# The benchmarks. Each one adds (name, fn, setup) entries to the list.
+#
+#
+# A copy of the Marlin config files (from Marlin/ or a folder of example configs)
+# with links to the Marlin sources, so files can be changed without touching the repo
+#
+def make_workspace(root, tmp, config_dir=None):
+    work = Path(tmp, 'work')
+    shutil.rmtree(work, ignore_errors=True)
+    (work / 'Marlin').mkdir(parents=True)
+    for f in ('Configuration.h', 'Configuration_adv.h', 'config.ini'):
+        for src in (Path(config_dir or Path(root, 'Marlin'), f), Path(root, 'Marlin', f)):
+            if src.is_file():
+                shutil.copy2(src, work / 'Marlin' / f)
+                break
+    for link in ('Marlin/src', 'buildroot'):
+        try:
+            (work / link).symlink_to(Path(root, link), target_is_directory=True)
+        except OSError:
+            shutil.copytree(Path(root, link), work / link)
+    return work
+
+def firmware_bytes(size=256*1024):
+    return random.Random(0).randbytes(size)
+
+def gather_benchmarks(root, tmp, config_dir=None):
+    import pypreprocessor, features, schema, signature, preprocessor
+
+    benches = []
+    work = make_workspace(root, tmp, config_dir)
+    build_dir = Path(tmp, 'build')
+
+    # The scripts use relative paths to the config files.
+    # The signature still gets the git version of the real repo.
+    os.chdir(work)
+    if Path(root, '.git').exists(): os.environ['GIT_DIR'] = str(Path(root, '.git'))
+
+    # Defines from the pure-Python preprocessor, with CONFIG_EXPORT so the signature does its work
+    benches.append(('pypreprocessor', lambda: pypreprocessor.run_preprocessor(), None))
+    define_lines = pypreprocessor.run_preprocessor().define_lines()
+    define_lines = [ l for l in define_lines if not l.startswith(b'#define CONFIG_EXPORT ') ] + [ b'#define CONFIG_EXPORT 1' ]
+    marlin_features = features.parse_define_list(define_lines)
+
+    def new_env(**kw):
+        env = FakeEnv(root, build_dir, **kw)
+        env['MARLIN_FEATURES'] = features.parse_define_list(define_lines)
+        preprocessor.preprocessor_cache.clear()
+        preprocessor.preprocessor_cache['buildroot/share/PlatformIO/scripts/common-dependencies.h'] = define_lines
+        return env
+
+    # MarlinHas for every [features] entry, starting with a fresh index
+    feature_names = [ k.upper() for k, v in FakeProjectConfig(new_env()).items('features') ]
+    def marlin_has():
+        index = features.FeatureIndex(marlin_features)
+        for name in feature_names: index.has(name)
+    benches.append(('MarlinHas', marlin_has, None))
+    benches.append(('MarlinHasAll', lambda: features.FeatureIndex(marlin_features).has_all(feature_names), None))
+    benches.append(('MarlinFeatures.value', lambda: [ features.MarlinFeatures(marlin_features).value(k) for k in marlin_features ], None))
+
+    # common-dependencies.py, load_features and apply_features_config
+    if importlib.util.find_spec('platformio') is None:
+        print("Skipping common-dependencies benchmarks. The PlatformIO Python package is required.")
+    else:
+        def load_deps():
+            env = new_env()
+            install_fake_scons(env)
+            shutil.rmtree(build_dir, ignore_errors=True)
+            return env
+        benches.append(('common-dependencies.py', lambda env: run_script('common-dependencies.py', env), load_deps))
+
+        deps = run_script('common-dependencies.py', load_deps())
+        manifest = build_dir / 'benchmark' / 'features_manifest.json'
+        def clear_features(cached):
+            deps['FEATURE_CONFIG'].clear()
+            deps['LIB_NAMES'].clear()
+            if not cached: manifest.unlink(missing_ok=True)
+        benches.append(('load_features', lambda _: deps['load_features'](), lambda: clear_features(False)))
+        benches.append(('load_features (cached)', lambda _: deps['load_features'](), lambda: clear_features(True)))
+
+    # Schema extraction and grouping
+    schema_cache = Path(tmp, 'marlin_schema.pickle')
+    benches.append(('schema.extract', lambda: schema.extract(None), None))
+    benches.append(('schema.extract (cached)', lambda: schema.extract(schema_cache), None))
+    conf_schema = schema.extract(schema_cache)
+    benches.append(('schema.group_options', schema.group_options, lambda: deepcopy(conf_schema)))
+    schema_config = schema.schema_defines(conf_schema)
+    benches.append(('schema.active_options', lambda: schema.active_options(conf_schema, schema_config), None))
+
+    # The build signature, with no previous marlin_config.json
+    def signature_env():
+        env = new_env()
+        shutil.rmtree(build_dir / 'benchmark', ignore_errors=True)
+        (build_dir / 'benchmark').mkdir(parents=True)
+        return env
+    benches.append(('compute_build_signature', signature.compute_build_signature, signature_env))
+
+    # Apply all the sections of Marlin/config.ini to fresh copies of the config files.
+    # Import configuration.py as a module, not as a build script.
+    install_fake_scons(types.SimpleNamespace(IsIntegrationDump=lambda: True))
+    import configuration
+    pristine = { f: Path('Marlin', f).read_bytes() for f in ('Configuration.h', 'Configuration_adv.h') }
+    def config_ini():
+        for f, data in pristine.items(): Path('Marlin', f).write_bytes(data)
+        cp = configparser.ConfigParser()
+        cp.read(Path('Marlin', 'config.ini'))
+        if not cp.has_section('config:base'): cp.add_section('config:base')
+        cp.set('config:base', 'ini_use_config', 'all')
+        return cp
+    if Path('Marlin', 'config.ini').is_file():
+        benches.append(('configuration.apply_config_ini', configuration.apply_config_ini, config_ini))
+
+    # The firmware encryptors, on a 256K firmware image
+    fw_data = firmware_bytes()
+    fw_path = build_dir / 'benchmark' / 'firmware.bin'
+    def firmware():
+        fw_path.parent.mkdir(parents=True, exist_ok=True)
+        fw_path.write_bytes(fw_data)
+        return [ FakeNode(fw_path) ]
+
+    def encryptor(script, board):
+        env = new_env(board=board)
+        install_fake_scons(env)
+        run_script(script, env)
+        action = env.post_actions[-1]
+        return lambda target: action(None, target, env)
+
+    import marlin
+    mks_env = new_env()
+    benches.append(('encrypt_mks', lambda target: marlin.encrypt_mks(None, target, mks_env, 'Robin.bin'), firmware))
+    benches.append(('chitu_crypt', encryptor('chitu_crypt.py', { 'build': { 'crypt_chitu': 'update.cbd' } }), firmware))
+    benches.append(('lerdge', encryptor('lerdge.py', { 'build': { 'crypt_lerdge': 'Lerdge.bin' } }), firmware))
+
+    return benches
+
+#
+# Make a marlin_config.json the way the build signature does, for a config without a build
+#
+def make_config_json(root, tmp, config_dir=None):
+    import pypreprocessor, features, preprocessor, signature
+    work = make_workspace(root, tmp, config_dir)
+    os.chdir(work)
+    if Path(root, '.git').exists(): os.environ['GIT_DIR'] = str(Path(root, '.git'))
+    try:
+        define_lines = pypreprocessor.run_preprocessor().define_lines()
+        define_lines = [ l for l in define_lines if not l.startswith(b'#define CONFIG_EXPORT ') ] + [ b'#define CONFIG_EXPORT 1' ]
+        env = FakeEnv(root, Path(tmp, 'build'))
+        env['MARLIN_FEATURES'] = features.parse_define_list(define_lines)
+        preprocessor.preprocessor_cache.clear()
+        preprocessor.preprocessor_cache['buildroot/share/PlatformIO/scripts/common-dependencies.h'] = define_lines
+        outfile = Path(tmp, 'build', 'benchmark', 'marlin_config.json')
+        outfile.unlink(missing_ok=True)
+        outfile.parent.mkdir(parents=True, exist_ok=True)
+        signature.compute_build_signature(env)
+        return outfile.read_bytes()
+    finally:
+        os.chdir(root)
+
+#
+# Print the compressed size with each codec for each marlin_config.json
+#
+def compare_codecs(sources):
+    import signature
+    codecs = list(signature.CODECS)
+    try:
+        signature.import_heatshrink()
+    except ImportError:
+        print("Skipping HEATSHRINK. Try 'pip install heatshrink2'.")
+        codecs.remove('HEATSHRINK')
+
+    print(f"{'Config':<40} {'JSON':>8} " + ' '.join(f"{c:>10}" for c in codecs))
+    totals = dict.fromkeys(codecs, 0)
+    for name, data in sources:
+        sizes = {}
+        for codec in codecs:
+            sizes[codec] = len(signature.CODECS[codec](data, 'marlin_config.json'))
+            totals[codec] += sizes[codec]
+        print(f"{name[-40:]:<40} {len(data):>8} " + ' '.join(f"{sizes[c]:>10}" for c in codecs))
+
+    if len(sources) > 1:
+        print(f"{'Total':<40} {sum(len(d) for n, d in sources):>8} " + ' '.join(f"{totals[c]:>10}" for c in codecs))
+    base = totals[signature.DEFAULT_CODEC]
+    print(f"{'Bytes saved vs. ' + signature.DEFAULT_CODEC:<40} {'':>8} " + ' '.join(f"{base - totals[c]:>10}" for c in codecs))
+
+################################################################################
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, res in results.items():
+        base = baseline.get('results', {}).get(name)
+        if not base: continue
+        change = (res['median_ms'] - base['median_ms']) / max(base['median_ms'], 0.001) * 100
+        flag = ''
+        if change > tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f"{name:<40} {base['median_ms']:>10.2f} {res['median_ms']:>10.2f} {change:>+8.1f}%{flag}")
+    return regressions
+
+def main():
+    import argparse, contextlib, io
+
+    parser = argparse.ArgumentParser(description="Benchmark the Marlin PlatformIO scripts")
+    parser.add_argument('-c', '--config', dest='configs', action='append', default=[])
+    parser.add_argument('-n', '--repeat', type=int, default=5)
+    parser.add_argument('-k', '--keyword', dest='keywords', action='append', default=[])
+    parser.add_argument('-o', '--output', help="Save the results to a JSON baseline")
+    parser.add_argument('-b', '--baseline', help="Compare with a JSON baseline")
+    parser.add_argument('-t', '--tolerance', type=float, default=25.0, help="Allowed slowdown in percent")
+    parser.add_argument('--codecs', nargs='*', metavar='FILE', help="Compare the mc.zip size with each codec")
+    args = parser.parse_args()
+
+    root = Path.cwd()
+    if not (root / 'Marlin' / 'Configuration.h').is_file():
+        print("Error: Run this from the root of the Marlin repo.")
+        sys.exit(1)
+
+    if args.codecs is not None:
+        files = [ Path(f) for f in args.codecs ] or ([] if args.configs else sorted(root.glob('.pio/build/*/marlin_config.json')))
+        sources = [ (str(f), f.read_bytes()) for f in files ]
+        if not sources:
+            with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+                for config_dir in args.configs or [ None ]:
+                    sources.append((config_dir or 'Marlin', make_config_json(root, tmp, config_dir and Path(config_dir).resolve())))
+        compare_codecs(sources)
+        return
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for config_dir in args.configs or [ None ]:
+            if config_dir and not Path(config_dir, 'Configuration.h').is_file():
+                print(f"Error: No Configuration.h in {config_dir}")
+                sys.exit(1)
+            try:
+                benches = gather_benchmarks(root, tmp, config_dir and Path(config_dir).resolve())
+                for name, fn, setup in benches:
+                    if args.keywords and not any(k in name for k in args.keywords): continue
+                    if config_dir: name = f"{config_dir}: {name}"
+                    # Keep the scripts' own messages out of the results
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        results[name] = measure(max(1, args.repeat), fn, setup)
+                    res = results[name]
+                    print(f"{name:<40} median {res['median_ms']:>10.2f} ms   min {res['min_ms']:>10.2f} ms")
+            finally:
+                os.chdir(root)
+
+    if args.output:
+        baseline = {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'system': platform.system(),
+            'results': results
+        }
+        Path(args.output).write_text(json.dumps(baseline, indent=2) + '\n')
+        print(f"Saved results to {args.output}")
+
+    if args.baseline:
+        print()
+        print(f"{'Benchmark':<40} {'Baseline':>10} {'Current':>10} {'Change':>9}")
+        regressions = compare(results, json.loads(Path(args.baseline).read_text()), args.tolerance)
+        if regressions:
+            print(f"Slower than the baseline by more than {args.tolerance}%: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
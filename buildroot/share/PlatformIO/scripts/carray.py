@@ -0,0 +1,58 @@
+#
+# carray.py
+# Generate C arrays from binary data, as used by signature.py (mczip.h),
+# buildroot/share/scripts/gen-tft-image.py, and the FTDI EVE file2cpp.py
+# and img2cpp.py in Marlin/src/lcd/extui/ftdi_eve_touch_ui/ftdi_eve_lib/scripts
+#
+# Lines are formatted a chunk at a time with a lookup table, so even
+# megabytes of data take milliseconds. Input can be bytes, a sequence of
+# ints, or a binary file object, which is read in chunks.
+#
+from pathlib import Path
+
+HEX8 = [ '0x%02X' % b for b in range(256) ]
+
+# Read a binary file object in chunks, or pass through bytes / a sequence
+def chunks(data, size):
+    if hasattr(data, 'read'):
+        while True:
+            chunk = data.read(size)
+            if not chunk: break
+            yield chunk
+    else:
+        for i in range(0, len(data), size):
+            yield data[i:i+size]
+
+#
+# Yield the lines of an array body, each with 'per_line' values ending
+# with a comma. A file object is read 64 lines at a time.
+#
+def byte_lines(data, per_line=16, indent='  '):
+    for chunk in chunks(data, per_line * 64):
+        for i in range(0, len(chunk), per_line):
+            yield indent + ', '.join([ HEX8[b] for b in chunk[i:i+per_line] ]) + ',\n'
+
+def uint16_lines(values, per_line=16, indent='  '):
+    fmt = '0x{:04X}'.format
+    for i in range(0, len(values), per_line):
+        yield indent + ', '.join(map(fmt, values[i:i+per_line])) + ',\n'
+
+#
+# Return the text of a complete array declaration, e.g.,
+#   c_array('const unsigned char mc_zip[] PROGMEM', byte_lines(data))
+#
+def c_array(decl, lines):
+    return decl + ' = {\n' + ''.join(lines) + '};\n'
+
+# Write a file only if its contents would change, so its mtime doesn't
+# trigger a rebuild of everything that depends on it. Return True if written.
+def write_if_changed(filepath, data):
+    filepath = Path(filepath)
+    if isinstance(data, str): data = data.encode()
+    try:
+        if filepath.read_bytes() == data:
+            return False
+    except OSError:
+        pass
+    filepath.write_bytes(data)
+    return True
@@ -37,7 +37,8 @@ if pioutil.is_pio_build():
             import shutil
             shutil.copy(target[0].get_abspath(), env.subst("$PROJECT_BUILD_DIR/$PIOENV"))
 
-        env.AddPostAction("$PROGPATH", on_program_ready)
+        import profiler
+        env.AddPostAction("$PROGPATH", profiler.timed_action(on_program_ready))
 
     # On some platform, F_CPU is a runtime variable. Since it's used to convert from ns
     # to CPU cycles, this adds overhead preventing small delay (in the order of less than
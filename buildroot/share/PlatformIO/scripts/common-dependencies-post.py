@@ -13,4 +13,6 @@ if pioutil.is_pio_build():
 
     # We need to add the board build flags in a post script
     # so the platform build script doesn't overwrite the custom CCFLAGS
-    apply_board_build_flags()
+    import profiler
+    with profiler.span('common-dependencies-post.py'):
+        apply_board_build_flags()
@@ -5,14 +5,16 @@
 import pioutil
 if pioutil.is_pio_build():
 
-    import subprocess,os,re
+    import subprocess,os,re,json,hashlib
+    from pathlib import Path
+    import profiler
     Import("env")
 
     from platformio.package.meta import PackageSpec
-    from platformio.project.config import ProjectConfig
 
     verbose = 0
     FEATURE_CONFIG = {}
+    LIB_NAMES = {}      # lib_deps entry => package name
 
     def validate_pio():
         PIO_VERSION_MIN = (6, 0, 1)
@@ -66,21 +68,21 @@ if pioutil.is_pio_build():
             else:
                 for dep in re.split(r',\s*', line):
                     lib_name = re.sub(r'@([~^]|[<>]=?)?[\d.]+', '', dep.strip()).split('=').pop(0)
-                    lib_re = re.compile('(?!^' + lib_name + '\\b)')
                     if not 'lib_deps' in feat: feat['lib_deps'] = {}
-                    feat['lib_deps'] = list(filter(lib_re.match, feat['lib_deps'])) + [dep]
+                    # Keyed by library name, so a later entry replaces an earlier one
+                    feat['lib_deps'].pop(lib_name, None)
+                    feat['lib_deps'][lib_name] = dep
                     blab("[%s] lib_deps = %s" % (feature, dep), 3)
 
-    def load_features():
-        blab("========== Gather [features] entries...")
-        for key in ProjectConfig().items('features'):
-            feature = key[0].upper()
-            if not feature in FEATURE_CONFIG:
-                FEATURE_CONFIG[feature] = { 'lib_deps': [] }
-            add_to_feat_cnf(feature, key[1])
+    #
+    # The features manifest is FEATURE_CONFIG plus the package name of every
+    # lib_deps entry, saved in the env build folder. It only changes when
+    # ini/features.ini or the env's custom_marlin.* options change.
+    #
+    MANIFEST_VERSION = 1
 
-        # Add options matching custom_marlin.MY_OPTION to the pile
-        blab("========== Gather custom_marlin entries...")
+    def get_custom_marlin():
+        custom = []
         for n in env.GetProjectOptions():
             key = n[0]
             mat = re.match(r'custom_marlin\.(.+)', key)
@@ -90,106 +92,199 @@ if pioutil.is_pio_build():
                 except:
                     val = None
                 if val:
-                    opt = mat[1].upper()
-                    blab("%s.custom_marlin.%s = '%s'" % ( env['PIOENV'], opt, val ))
-                    add_to_feat_cnf(opt, val)
+                    custom.append((mat[1].upper(), val))
+        return custom
+
+    def manifest_key(custom):
+        sha = hashlib.sha256(str(MANIFEST_VERSION).encode())
+        try:
+            sha.update(Path(env['PROJECT_DIR'], 'ini', 'features.ini').read_bytes())
+        except OSError:
+            pass
+        sha.update(json.dumps(custom).encode())
+        return sha.hexdigest()
+
+    def manifest_path():
+        return Path(env['PROJECT_BUILD_DIR'], env['PIOENV'], 'features_manifest.json')
+
+    def load_features():
+        custom = get_custom_marlin()
+        key = manifest_key(custom)
+
+        try:
+            manifest = json.loads(manifest_path().read_text())
+            if manifest['key'] == key:
+                blab("========== Using cached features manifest...")
+                FEATURE_CONFIG.update(manifest['features'])
+                LIB_NAMES.update(manifest['lib_names'])
+                return key
+        except:
+            pass
+
+        blab("========== Gather [features] entries...")
+        for key_val in env.GetProjectConfig().items('features'):
+            feature = key_val[0].upper()
+            if not feature in FEATURE_CONFIG:
+                FEATURE_CONFIG[feature] = { 'lib_deps': {} }
+            add_to_feat_cnf(feature, key_val[1])
+
+        # Add options matching custom_marlin.MY_OPTION to the pile
+        blab("========== Gather custom_marlin entries...")
+        for opt, val in custom:
+            blab("%s.custom_marlin.%s = '%s'" % ( env['PIOENV'], opt, val ))
+            add_to_feat_cnf(opt, val)
+
+        # Keep the lib_deps in order, and get each package name just once
+        for feat in FEATURE_CONFIG.values():
+            if 'lib_deps' in feat:
+                feat['lib_deps'] = list(feat['lib_deps'].values())
+                for dep in feat['lib_deps']:
+                    LIB_NAMES[dep] = PackageSpec(dep).name
+
+        try:
+            path = manifest_path()
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(json.dumps({ 'key': key, 'features': FEATURE_CONFIG, 'lib_names': LIB_NAMES }, indent=2))
+        except OSError:
+            pass
+
+        return key
+
+    def lib_name(dep):
+        if dep not in LIB_NAMES:
+            LIB_NAMES[dep] = PackageSpec(dep).name
+        return LIB_NAMES[dep]
 
     def get_all_known_libs():
-        known_libs = []
-        for feature in FEATURE_CONFIG:
-            feat = FEATURE_CONFIG[feature]
-            if not 'lib_deps' in feat:
-                continue
-            for dep in feat['lib_deps']:
-                known_libs.append(PackageSpec(dep).name)
+        known_libs = set()
+        for feat in FEATURE_CONFIG.values():
+            for dep in feat.get('lib_deps', []):
+                known_libs.add(lib_name(dep))
         return known_libs
 
-    def get_all_env_libs():
-        env_libs = []
-        lib_deps = env.GetProjectOption('lib_deps')
-        for dep in lib_deps:
-            env_libs.append(PackageSpec(dep).name)
-        return env_libs
-
     def set_env_field(field, value):
         proj = env.GetProjectConfig()
         proj.set("env:" + env['PIOENV'], field, value)
 
-    # All unused libs should be ignored so that if a library
-    # exists in .pio/lib_deps it will not break compilation.
-    def force_ignore_unused_libs():
-        env_libs = get_all_env_libs()
-        known_libs = get_all_known_libs()
-        diff = (list(set(known_libs) - set(env_libs)))
-        lib_ignore = env.GetProjectOption('lib_ignore') + diff
-        blab("Ignore libraries: %s" % lib_ignore)
-        set_env_field('lib_ignore', lib_ignore)
+    # Split a src_filter into its '+<path>' / '-<path>' items
+    def filter_items(src_filter):
+        return re.findall(r'[+-]<.*?>', src_filter)
 
-    def apply_features_config():
-        load_features()
-        blab("========== Apply enabled features...")
-        for feature in FEATURE_CONFIG:
-            if not env.MarlinHas(feature):
+    #
+    # Resolve all enabled features (a dict of feature => enabled) in one pass, giving a plan with:
+    #   enabled          - Enabled features with a config, in order
+    #   lib_deps         - Libraries to add to lib_deps
+    #   lib_ignore       - Libraries to add to lib_ignore, including all unused libs
+    #   build_flags      - Flags to add to the project build_flags
+    #   build_src_filter - The new build_src_filter, or None to leave it alone
+    #   extra_scripts    - Scripts to run after the plan is applied
+    #
+    def plan_features_config(base, enabled):
+        blab("========== Plan enabled features...")
+        plan = { 'enabled': [], 'lib_deps': [], 'lib_ignore': [], 'build_flags': [], 'build_src_filter': None, 'extra_scripts': [] }
+        have = { lib_name(dep) for dep in base['lib_deps'] }
+        src_items = filter_items(' '.join(base['src_filter']))
+
+        for feature, feat in FEATURE_CONFIG.items():
+            if not enabled[feature]:
                 continue
 
-            feat = FEATURE_CONFIG[feature]
+            plan['enabled'].append(feature)
 
-            if 'lib_deps' in feat and len(feat['lib_deps']):
-                blab("========== Adding lib_deps for %s... " % feature, 2)
-
-                # feat to add
-                deps_to_add = {}
-                for dep in feat['lib_deps']:
-                    deps_to_add[PackageSpec(dep).name] = dep
-                    blab("==================== %s... " % dep, 2)
-
-                # Does the env already have the dependency?
-                deps = env.GetProjectOption('lib_deps')
-                for dep in deps:
-                    name = PackageSpec(dep).name
-                    if name in deps_to_add:
-                        del deps_to_add[name]
-
-                # Are there any libraries that should be ignored?
-                lib_ignore = env.GetProjectOption('lib_ignore')
-                for dep in deps:
-                    name = PackageSpec(dep).name
-                    if name in deps_to_add:
-                        del deps_to_add[name]
-
-                # Is there anything left?
-                if len(deps_to_add) > 0:
-                    # Only add the missing dependencies
-                    set_env_field('lib_deps', deps + list(deps_to_add.values()))
+            # Only add libraries the env doesn't already have
+            for dep in feat.get('lib_deps', []):
+                if lib_name(dep) not in have:
+                    blab("[%s] Adding lib_deps %s" % (feature, dep), 2)
+                    have.add(lib_name(dep))
+                    plan['lib_deps'].append(dep)
 
             if 'build_flags' in feat:
-                f = feat['build_flags']
-                blab("========== Adding build_flags for %s: %s" % (feature, f), 2)
-                new_flags = env.GetProjectOption('build_flags') + [ f ]
-                env.Replace(BUILD_FLAGS=new_flags)
+                blab("[%s] Adding build_flags %s" % (feature, feat['build_flags']), 2)
+                plan['build_flags'].append(feat['build_flags'])
 
             if 'extra_scripts' in feat:
-                blab("Running extra_scripts for %s... " % feature, 2)
-                env.SConscript(feat['extra_scripts'], exports="env")
+                plan['extra_scripts'].append(feat['extra_scripts'])
 
+            # Put the feature's filters first, replacing any for the same paths
             if 'src_filter' in feat:
-                blab("========== Adding build_src_filter for %s... " % feature, 2)
-                src_filter = ' '.join(env.GetProjectOption('src_filter'))
-                # first we need to remove the references to the same folder
-                my_srcs = re.findall(r'[+-](<.*?>)', feat['src_filter'])
-                cur_srcs = re.findall(r'[+-](<.*?>)', src_filter)
-                for d in my_srcs:
-                    if d in cur_srcs:
-                        src_filter = re.sub(r'[+-]' + d, '', src_filter)
-
-                src_filter = feat['src_filter'] + ' ' + src_filter
-                set_env_field('build_src_filter', [src_filter])
-                env.Replace(SRC_FILTER=src_filter)
+                blab("[%s] Adding build_src_filter %s" % (feature, feat['src_filter']), 2)
+                my_items = filter_items(feat['src_filter'])
+                my_paths = { item[1:] for item in my_items }
+                src_items = my_items + [ item for item in src_items if item[1:] not in my_paths ]
+                plan['build_src_filter'] = ' '.join(src_items)
 
             if 'lib_ignore' in feat:
-                blab("========== Adding lib_ignore for %s... " % feature, 2)
-                lib_ignore = env.GetProjectOption('lib_ignore') + [feat['lib_ignore']]
-                set_env_field('lib_ignore', lib_ignore)
+                blab("[%s] Adding lib_ignore %s" % (feature, feat['lib_ignore']), 2)
+                plan['lib_ignore'].append(feat['lib_ignore'])
+
+        # All unused libs should be ignored so that if a library
+        # exists in .pio/lib_deps it will not break compilation.
+        plan['lib_ignore'] += sorted(get_all_known_libs() - have)
+
+        return plan
+
+    def plan_key(manifest, base, enabled):
+        sha = hashlib.sha256(manifest.encode())
+        sha.update(json.dumps([ base, enabled ]).encode())
+        return sha.hexdigest()
+
+    def plan_path():
+        return Path(env['PROJECT_BUILD_DIR'], env['PIOENV'], 'features_plan.json')
+
+    #
+    # Apply the plan to the project config all at once
+    #
+    def apply_plan(base, plan):
+        if plan['lib_deps']:
+            set_env_field('lib_deps', base['lib_deps'] + plan['lib_deps'])
+
+        lib_ignore = base['lib_ignore'] + plan['lib_ignore']
+        blab("Ignore libraries: %s" % lib_ignore)
+        set_env_field('lib_ignore', lib_ignore)
+
+        if plan['build_flags']:
+            env.Replace(BUILD_FLAGS=base['build_flags'] + plan['build_flags'])
+
+        if plan['build_src_filter'] is not None:
+            set_env_field('build_src_filter', [plan['build_src_filter']])
+            env.Replace(SRC_FILTER=plan['build_src_filter'])
+
+        for script in plan['extra_scripts']:
+            blab("Running extra_scripts %s... " % script, 2)
+            with profiler.span(script, 'extra_script'):
+                env.SConscript(script, exports="env")
+
+    #
+    # Plan and apply the config for enabled features. The plan is saved as
+    # features_plan.json in the env build folder so it can be compared with
+    # other builds. It's only re-planned (and the file re-written) when the
+    # features manifest, the enabled features, or the env options change.
+    #
+    def apply_features_config():
+        manifest = load_features()
+
+        base = { opt: env.GetProjectOption(opt) for opt in ('lib_deps', 'lib_ignore', 'build_flags', 'src_filter') }
+        enabled = env.MarlinHasAll(list(FEATURE_CONFIG))
+        key = plan_key(manifest, base, [ f for f in FEATURE_CONFIG if enabled[f] ])
+
+        try:
+            plan = json.loads(plan_path().read_text())
+            if plan.pop('key') != key: plan = None
+        except:
+            plan = None
+
+        if plan:
+            blab("========== Features plan is unchanged")
+        else:
+            plan = plan_features_config(base, enabled)
+            try:
+                plan_path().parent.mkdir(parents=True, exist_ok=True)
+                plan_path().write_text(json.dumps({ 'key': key, **plan }, indent=2))
+            except OSError:
+                pass
+
+        blab("========== Apply enabled features...")
+        apply_plan(base, plan)
 
     #
     # Use the compiler to get a list of all enabled features
@@ -199,34 +294,43 @@ if pioutil.is_pio_build():
             return
 
         # Process defines
-        from preprocessor import run_preprocessor
-        define_list = run_preprocessor(env)
-        marlin_features = {}
-        for define in define_list:
-            feature = define[8:].strip().decode().split(' ')
-            feature, definition = feature[0], ' '.join(feature[1:])
-            marlin_features[feature] = definition
-        env['MARLIN_FEATURES'] = marlin_features
+        from preprocessor import run_preprocessor, get_dependencies, write_dependency_manifest
+        from features import parse_define_list
+        env['MARLIN_FEATURES'] = parse_define_list(run_preprocessor(env))
+
+        # Headers that MARLIN_FEATURES depends on, for invalidation by other scripts
+        env['MARLIN_FEATURES_DEPS'] = get_dependencies(env)
+        write_dependency_manifest(env)
+
+    #
+    # Get the feature index for the current env, built once from MARLIN_FEATURES
+    #
+    def feature_index(env):
+        if 'MARLIN_FEATURE_INDEX' not in env:
+            load_marlin_features()
+            from features import FeatureIndex
+            env['MARLIN_FEATURE_INDEX'] = FeatureIndex(env['MARLIN_FEATURES'])
+        return env['MARLIN_FEATURE_INDEX']
 
     #
     # Return True if a matching feature is enabled
     #
     def MarlinHas(env, feature):
-        load_marlin_features()
-        r = re.compile('^' + feature + '$')
-        found = list(filter(r.match, env['MARLIN_FEATURES']))
+        return feature_index(env).has(feature)
 
-        # Defines could still be 'false' or '0', so check
-        some_on = False
-        if len(found):
-            for f in found:
-                val = env['MARLIN_FEATURES'][f]
-                if val in [ '', '1', 'true' ]:
-                    some_on = True
-                elif val in env['MARLIN_FEATURES']:
-                    some_on = env.MarlinHas(val)
+    #
+    # Return a dict of feature => True/False for a list of features
+    #
+    def MarlinHasAll(env, features):
+        return feature_index(env).has_all(features)
 
-        return some_on
+    #
+    # Return the parsed value of a define (int, float, bool, str, list)
+    # or the default if it's not defined (or not of the given type)
+    #
+    def MarlinValue(env, name, default=None, type=None):
+        load_marlin_features()
+        return env['MARLIN_FEATURES'].value(name, default, type)
 
     validate_pio()
 
@@ -236,17 +340,20 @@ if pioutil.is_pio_build():
         pass
 
     #
-    # Add a method for other PIO scripts to query enabled features
+    # Add methods for other PIO scripts to query enabled features
     #
     env.AddMethod(MarlinHas)
+    env.AddMethod(MarlinHasAll)
+    env.AddMethod(MarlinValue)
 
     #
     # Add dependencies for enabled Marlin features
     #
-    apply_features_config()
-    force_ignore_unused_libs()
+    with profiler.span('apply_features_config', 'step'):
+        apply_features_config()
 
     #print(env.Dump())
 
     from signature import compute_build_signature
-    compute_build_signature(env)
+    with profiler.span('compute_build_signature', 'step'):
+        compute_build_signature(env)
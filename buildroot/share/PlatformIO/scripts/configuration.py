@@ -2,8 +2,10 @@
 # configuration.py
 # Apply options from config.ini to the existing Configuration headers
 #
-import re, shutil, configparser
+import re, os, json, shutil, hashlib, subprocess, configparser
 from pathlib import Path
+from carray import write_if_changed
+import fetch
 
 verbose = 0
 def blab(str,level=1):
@@ -12,45 +14,118 @@ def blab(str,level=1):
 def config_path(cpath):
     return Path("Marlin", cpath, encoding='utf-8')
 
-# Apply a single name = on/off ; name = value ; etc.
-# TODO: Limit to the given (optional) configuration
-def apply_opt(name, val, conf=None):
-    if name == "lcd": name, val = val, "on"
-
-    # Create a regex to match the option and capture parts of the line
-    regex = re.compile(rf'^(\s*)(//\s*)?(#define\s+)({name}\b)(\s*)(.*?)(\s*)(//.*)?$', re.IGNORECASE)
-
-    # Find and enable and/or update all matches
-    for file in ("Configuration.h", "Configuration_adv.h"):
-        fullpath = config_path(file)
-        lines = fullpath.read_text(encoding='utf-8').split('\n')
-        found = False
-        for i in range(len(lines)):
-            line = lines[i]
-            match = regex.match(line)
-            if match and match[4].upper() == name.upper():
-                found = True
+#
+# The Configuration headers, loaded once and edited in memory so that a whole
+# config.ini is applied with a single read and write of each file.
+# Each file is a list of lines, with an index of the lines that define
+# (or have a commented-out define of) each name.
+#
+define_line = re.compile(r'^(\s*)(//\s*)?(#define\s+)(\w+)(\s*)(.*?)(\s*)(//.*)?$', re.IGNORECASE)
+enable_define = re.compile(r'^(\s*)//+\s*(#define)(\s{1,3})?(\s*)')
+disable_define = re.compile(r'^(\s*)(#define)(\s{1,3})?(\s*)')
+
+class ConfigLine:
+    __slots__ = ('text',)
+    def __init__(self, text):
+        self.text = text
+
+class ConfigFile:
+
+    # Load the file, or use the given text in place of the file's contents
+    def __init__(self, filename, text=None):
+        self.path = config_path(filename)
+        try:
+            self.text = self.path.read_text(encoding='utf-8')
+        except OSError:
+            if text is None: raise
+            self.text = None
+        if text is None: text = self.text
+        self.lines = [ ConfigLine(line) for line in text.split('\n') ]
+        self.index = {}     # NAME => [ ConfigLine, ... ]
+        for line in self.lines: self.add_index(line)
+        self.changed = text != self.text
+
+    def add_index(self, line):
+        if '#' in line.text:
+            match = define_line.match(line.text)
+            if match: self.index.setdefault(match[4].upper(), []).append(line)
+
+    # The line after the first set of #define lines
+    def insert_point(self):
+        end = len(self.lines) - (self.lines[-1].text == '')
+        gotdef = False
+        for linenum in range(end):
+            isdef = self.lines[linenum].text.startswith("#define")
+            if not gotdef:
+                gotdef = isdef
+            elif not isdef:
+                return linenum
+        return end
+
+    def insert(self, text):
+        line = ConfigLine(text)
+        self.lines.insert(self.insert_point(), line)
+        self.add_index(line)
+        self.changed = True
+
+    # Write the file, if changed, by replacing it with a new file all at once.
+    # If the text ends up the same as before leave the file alone, so its mtime
+    # doesn't force a rebuild of everything that includes MarlinConfig.h.
+    def save(self):
+        if not self.changed: return
+        self.changed = False
+        text = '\n'.join(line.text for line in self.lines)
+        if text == self.text: return
+        temp = self.path.with_name(self.path.name + '.tmp')
+        temp.write_text(text, encoding='utf-8')
+        if self.path.exists(): shutil.copymode(self.path, temp)
+        os.replace(temp, self.path)
+        self.text = text
+        blab(f"Wrote {self.path}")
+
+class ConfigFiles:
+
+    def __init__(self):
+        self.files = {}
+
+    def file(self, filename):
+        if filename not in self.files:
+            self.files[filename] = ConfigFile(filename)
+        return self.files[filename]
+
+    # Replace a file's contents, e.g., with a fetched example
+    def load(self, filename, text):
+        self.files[filename] = ConfigFile(filename, text)
+
+    # Apply a single name = on/off ; name = value ; etc.
+    def apply(self, name, val):
+        if name == "lcd": name, val = val, "on"
+
+        # Find and enable and/or update all matches
+        for filename in ("Configuration.h", "Configuration_adv.h"):
+            cfile = self.file(filename)
+            lines = cfile.index.get(name.upper())
+            if not lines: continue
+            for line in lines:
                 # For boolean options un/comment the define
                 if val in ("on", "", None):
-                    newline = re.sub(r'^(\s*)//+\s*(#define)(\s{1,3})?(\s*)', r'\1\2 \4', line)
+                    newline = enable_define.sub(r'\1\2 \4', line.text)
                 elif val == "off":
-                    newline = re.sub(r'^(\s*)(#define)(\s{1,3})?(\s*)', r'\1//\2 \4', line)
+                    newline = disable_define.sub(r'\1//\2 \4', line.text)
                 else:
-                    # For options with values, enable and set the value
-                    newline = match[1] + match[3] + match[4] + match[5] + val
+                    # For options with values, enable and set the value.
+                    # (A define with nothing after the name needs a space.)
+                    match = define_line.match(line.text)
+                    newline = match[1] + match[3] + match[4] + (match[5] or ' ') + val
                     if match[8]:
                         sp = match[7] if match[7] else ' '
                         newline += sp + match[8]
-                lines[i] = newline
+                line.text = newline
+                cfile.changed = True
                 blab(f"Set {name} to {val}")
+            return
 
-        # If the option was found, write the modified lines
-        if found:
-            fullpath.write_text('\n'.join(lines), encoding='utf-8')
-            break
-
-    # If the option didn't appear in either config file, add it
-    if not found:
+        # If the option didn't appear in either config file, add it.
         # OFF options are added as disabled items so they appear
         # in config dumps. Useful for custom settings.
         prefix = ""
@@ -66,62 +141,57 @@ def apply_opt(name, val, conf=None):
             added += " " + val
 
         # Prepend the new option after the first set of #define lines
-        fullpath = config_path("Configuration.h")
-        with fullpath.open(encoding='utf-8') as f:
-            lines = f.readlines()
-            linenum = 0
-            gotdef = False
-            for line in lines:
-                isdef = line.startswith("#define")
-                if not gotdef:
-                    gotdef = isdef
-                elif not isdef:
-                    break
-                linenum += 1
-            lines.insert(linenum, f"{prefix}#define {added:30} // Added by config.ini\n")
-            fullpath.write_text(''.join(lines), encoding='utf-8')
-
-# Fetch configuration files from GitHub given the path.
-# Return True if any files were fetched.
-def fetch_example(url):
+        self.file("Configuration.h").insert(f"{prefix}#define {added:30} // Added by config.ini")
+
+    # Write all the changed files
+    def save(self):
+        for cfile in self.files.values(): cfile.save()
+
+# Apply a single name = on/off ; name = value ; etc.
+# Given ConfigFiles the change is only made in memory, to be written by its save().
+def apply_opt(name, val, configs=None):
+    if configs is not None:
+        configs.apply(name, val)
+    else:
+        configs = ConfigFiles()
+        configs.apply(name, val)
+        configs.save()
+
+# Fetch configuration files from GitHub (or a mirror, or the cache) given the path.
+# Given ConfigFiles the Configuration headers are only loaded into it, to be
+# written by its save(). Return True if any files were fetched.
+def fetch_example(url, configs=None):
     if url.endswith("/"): url = url[:-1]
-    if not url.startswith('http'):
+    filenames = ("Configuration.h", "Configuration_adv.h", "_Bootscreen.h", "_Statusscreen.h")
+    if url.startswith('http'):
+        url = url.replace("%", "%25").replace(" ", "%20")
+        files, errors = fetch.fetch_files(url, filenames)
+    else:
         brch = "bugfix-2.1.x"
         if '@' in url: url, brch = map(str.strip, url.split('@'))
         if url == 'examples/default': url = 'default'
-        url = f"https://raw.githubusercontent.com/MarlinFirmware/Configurations/{brch}/config/{url}"
-    url = url.replace("%", "%25").replace(" ", "%20")
-
-    # Find a suitable fetch command
-    if shutil.which("curl") is not None:
-        fetch = "curl -L -s -S -f -o"
-    elif shutil.which("wget") is not None:
-        fetch = "wget -q -O"
-    else:
-        blab("Couldn't find curl or wget", -1)
-        return False
-
-    import os
+        files, errors = fetch.fetch_example(url, brch, filenames)
 
-    # Reset configurations to default
-    os.system("git checkout HEAD Marlin/*.h")
+    for err in errors: blab(err, -1)
+    if not files: blab(f"Couldn't fetch {url}", -1)
 
-    # Try to fetch the remote files
-    gotfile = False
-    for fn in ("Configuration.h", "Configuration_adv.h", "_Bootscreen.h", "_Statusscreen.h"):
-        if os.system(f"{fetch} wgot {url}/{fn} >/dev/null 2>&1") == 0:
-            shutil.move('wgot', config_path(fn))
-            gotfile = True
+    # Reset the other configurations to default
+    subprocess.run([ 'git', 'checkout', 'HEAD', '--', ':(glob)Marlin/*.h' ] + [ f':(exclude)Marlin/{fn}' for fn in files ])
 
-    if Path('wgot').exists(): shutil.rmtree('wgot')
+    # Write the fetched files, leaving alone any that haven't changed
+    for fn, data in files.items():
+        if configs is not None and fn in ("Configuration.h", "Configuration_adv.h"):
+            configs.load(fn, data.decode('utf-8'))
+        else:
+            write_if_changed(config_path(fn), data)
 
-    return gotfile
+    return len(files) > 0
 
 def section_items(cp, sectkey):
     return cp.items(sectkey) if sectkey in cp.sections() else []
 
 # Apply all items from a config section
-def apply_ini_by_name(cp, sect):
+def apply_ini_by_name(cp, sect, configs=None):
     iniok = True
     if sect in ('config:base', 'config:root'):
         iniok = False
@@ -131,36 +201,80 @@ def apply_ini_by_name(cp, sect):
 
     for item in items:
         if iniok or not item[0].startswith('ini_'):
-            apply_opt(item[0], item[1])
+            apply_opt(item[0], item[1], configs)
 
 # Apply all config sections from a parsed file
-def apply_all_sections(cp):
+def apply_all_sections(cp, configs=None):
     for sect in cp.sections():
         if sect.startswith('config:'):
-            apply_ini_by_name(cp, sect)
+            apply_ini_by_name(cp, sect, configs)
 
 # Apply certain config sections from a parsed file
-def apply_sections(cp, ckey='all'):
+def apply_sections(cp, ckey='all', configs=None):
     blab(f"Apply section key: {ckey}")
     if ckey == 'all':
-        apply_all_sections(cp)
+        apply_all_sections(cp, configs)
     else:
         # Apply the base/root config.ini settings after external files are done
         if ckey in ('base', 'root'):
-            apply_ini_by_name(cp, 'config:base')
+            apply_ini_by_name(cp, 'config:base', configs)
 
         # Apply historically 'Configuration.h' settings everywhere
         if ckey == 'basic':
-            apply_ini_by_name(cp, 'config:basic')
+            apply_ini_by_name(cp, 'config:basic', configs)
 
         # Apply historically Configuration_adv.h settings everywhere
         # (Some of which rely on defines in 'Conditionals_LCD.h')
         elif ckey in ('adv', 'advanced'):
-            apply_ini_by_name(cp, 'config:advanced')
+            apply_ini_by_name(cp, 'config:advanced', configs)
 
         # Apply a specific config:<name> section directly
         elif ckey.startswith('config:'):
-            apply_ini_by_name(cp, ckey)
+            apply_ini_by_name(cp, ckey, configs)
+
+#
+# The apply stamp records the config.ini options last applied and a hash of the
+# headers they produced. Applying the same options to the same headers again
+# is skipped. Change STAMP_VERSION when the way options are applied changes.
+#
+STAMP_VERSION = 1
+STAMP_FILE = Path('.pio', 'build', 'config_ini.stamp')
+
+def options_key(cp, config_keys):
+    sha = hashlib.sha256(str(STAMP_VERSION).encode())
+    for sect in cp.sections():
+        if sect.startswith('config:'):
+            sha.update(repr((sect, section_items(cp, sect))).encode())
+    # Include the contents of other .ini files named by ini_use_config
+    for ckey in config_keys:
+        if ckey.endswith('.ini'):
+            try:
+                sha.update(config_path(ckey.split('@')[-1].strip()).read_bytes())
+            except OSError:
+                sha.update(b'-')
+    return sha.hexdigest()
+
+def headers_key():
+    sha = hashlib.sha256()
+    for fn in ("Configuration.h", "Configuration_adv.h"):
+        try:
+            sha.update(config_path(fn).read_bytes())
+        except OSError:
+            sha.update(b'-')
+    return sha.hexdigest()
+
+def read_stamp():
+    try:
+        return json.loads(STAMP_FILE.read_text())
+    except (OSError, ValueError):
+        return None
+
+def write_stamp(options):
+    try:
+        STAMP_FILE.parent.mkdir(parents=True, exist_ok=True)
+        STAMP_FILE.write_text(json.dumps({ 'options': options, 'headers': headers_key() }))
+    except OSError:
+        pass
 
 # Apply settings from a top level config.ini
 def apply_config_ini(cp):
@@ -171,7 +285,18 @@ def apply_config_ini(cp):
     config_keys = ['base']
     for ikey, ival in base_items:
         if ikey == 'ini_use_config':
-            config_keys = map(str.strip, ival.split(','))
+            config_keys = list(map(str.strip, ival.split(',')))
+
+    # Skip an apply already done, unless it fetches files that may have changed
+    stamp = None
+    if not any(ckey.startswith(('example', 'http')) for ckey in config_keys):
+        stamp = options_key(cp, config_keys)
+        if read_stamp() == { 'options': stamp, 'headers': headers_key() }:
+            blab("Options already applied")
+            return
+
+    # Apply all the options in memory, writing each file once at the end
+    configs = ConfigFiles()
 
     # For each ini_use_config item perform an action
     for ckey in config_keys:
@@ -183,7 +308,7 @@ def apply_config_ini(cp):
             if '@' in ckey: sect, ckey = map(str.strip, ckey.split('@'))
             cp2 = configparser.ConfigParser()
             cp2.read(config_path(ckey))
-            apply_sections(cp2, sect)
+            apply_sections(cp2, sect, configs)
             ckey = 'base';
 
         # (Allow 'example/' as a shortcut for 'examples/')
@@ -193,15 +318,21 @@ def apply_config_ini(cp):
         # For 'examples/<path>' fetch an example set from GitHub.
         # For https?:// do a direct fetch of the URL.
         if ckey.startswith('examples/') or ckey.startswith('http'):
-            fetch_example(ckey)
+            # Write pending changes first, then start over with the fetched files, in memory
+            configs.save()
+            configs = ConfigFiles()
+            fetch_example(ckey, configs)
             ckey = 'base'
 
         if ckey == 'all':
-            apply_sections(cp)
+            apply_sections(cp, configs=configs)
 
         else:
             # Apply keyed sections after external files are done
-            apply_sections(cp, 'config:' + ckey)
+            apply_sections(cp, 'config:' + ckey, configs)
+
+    configs.save()
+    if stamp: write_stamp(stamp)
 
 if __name__ == "__main__":
     #
@@ -236,5 +367,7 @@ else:
         except:
             pass
 
+        import profiler
         from platformio.project.config import ProjectConfig
-        apply_config_ini(ProjectConfig())
+        with profiler.span('configuration.py'):
+            apply_config_ini(ProjectConfig())
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+#
+# extract-features.py
+#
+# Get the enabled Marlin features (MARLIN_FEATURES) for many PlatformIO
+# environments at once, without running a full 'pio run' for each one.
+# Each env is preprocessed in its own process, writing one JSON feature map
+# per env. Run this from the root of the Marlin repo.
+#
+# Usage: extract-features.py [-e ENV]... [-j JOBS] [-o OUTDIR] [--python] [--cxx CXX]
+#
+#   -e ENV     Extract features for ENV. May be repeated. (Default: all envs)
+#   -j JOBS    Number of parallel jobs. (Default: the number of CPU cores)
+#   -o OUTDIR  Folder for the <env>.json files. (Default: .pio/features)
+#   --python   Use the pure-Python preprocessor instead of the env's compiler
+#   --cxx CXX  Use the given compiler for all envs
+#
+# Requires the PlatformIO Python package to read the project configuration.
+#
+import os, re, sys, json, shlex
+from pathlib import Path
+
+# Allow the script to be run from anywhere in the repo
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+def pio_core_dir():
+    return Path(os.environ.get('PLATFORMIO_CORE_DIR', Path.home() / '.platformio'))
+
+#
+# A minimal stand-in for the SCons env used by preprocessor.run_preprocessor
+#
+class ScriptEnv(dict):
+
+    def __init__(self, pioenv, build_flags, cxx):
+        super().__init__(
+            PIOENV=pioenv,
+            PROJECT_BUILD_DIR=str(Path('.pio', 'build').resolve()),
+            PROJECT_PACKAGES_DIR=str(pio_core_dir() / 'packages'),
+            PLATFORM=sys.platform,
+            ENV={ 'PATH': os.environ.get('PATH', '') },
+            BUILD_FLAGS=build_flags,
+            CXX=cxx
+        )
+
+    def GetProjectOption(self, option, default=None):
+        if option == 'custom_gcc' and self['CXX']: return self['CXX']
+        if default is not None: return default
+        raise KeyError(option)
+
+    # Only the defines matter to the preprocessor
+    def ParseFlagsExtended(self, flags):
+        cppdefines, args = [], []
+        for flag in flags or []:
+            args += shlex.split(flag)
+        args = iter(args)
+        for arg in args:
+            if arg == '-D': arg = '-D' + next(args, '')
+            if arg.startswith('-D') and len(arg) > 2:
+                name, eq, value = arg[2:].partition('=')
+                cppdefines.append((name, value) if eq else name)
+        return { 'CPPDEFINES': cppdefines }
+
+#
+# Find the cross compiler for a PlatformIO platform, as installed by PlatformIO
+#
+def find_compiler(platform):
+    name = re.split(r'[@ ]', platform.strip())[0].rstrip('/').split('/')[-1]
+    name = re.sub(r'^platform-|\.git$|\.zip$', '', name)
+    core = pio_core_dir()
+    gcc_exe = '*g++.exe' if sys.platform == 'win32' else '*g++'
+    for manifest in sorted(core.glob(f'platforms/{name}*/platform.json')):
+        packages = json.loads(manifest.read_text()).get('packages', {})
+        for pkg, info in packages.items():
+            if info.get('type') != 'toolchain': continue
+            for pkgdir in sorted(core.glob(f'packages/{pkg}*')):
+                for gpath in sorted((pkgdir / 'bin').glob(gcc_exe)):
+                    return str(gpath.resolve())
+    return None
+
+#
+# Extract the features for a single env. Runs in a worker process.
+#
+def extract_env(pioenv, build_flags, cxx, use_python, outdir):
+    from features import parse_define_list
+    try:
+        if use_python or not cxx:
+            import pypreprocessor, preprocessor
+            env = ScriptEnv(pioenv, build_flags, None)
+            # Use the builtin defines of a known compiler, memoized by the compiler registry
+            builtins = preprocessor.compiler_builtins(env, cxx) if cxx else None
+            pp = pypreprocessor.run_preprocessor(env.ParseFlagsExtended(build_flags)['CPPDEFINES'], builtins=builtins)
+            define_list, how = pp.define_lines(), 'python'
+        else:
+            import preprocessor
+            # Workers are reused, so don't get the previous env's results
+            preprocessor.preprocessor_cache.clear()
+            define_list, how = preprocessor.run_preprocessor(ScriptEnv(pioenv, build_flags, cxx)), cxx
+        features = parse_define_list(define_list)
+    except Exception as exc:
+        return pioenv, None, str(exc)
+
+    if not features:
+        return pioenv, None, f"no features from {how}"
+
+    outfile = Path(outdir, pioenv + '.json')
+    outfile.write_text(json.dumps(features, indent=2, sort_keys=True))
+    return pioenv, str(outfile), how
+
+def main():
+    import argparse
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    parser = argparse.ArgumentParser(description="Extract MARLIN_FEATURES for many PlatformIO envs in parallel")
+    parser.add_argument('-e', '--environment', dest='envs', action='append', default=[], metavar='ENV')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('-o', '--outdir', default=str(Path('.pio', 'features')))
+    parser.add_argument('--python', action='store_true', help="Use the pure-Python preprocessor")
+    parser.add_argument('--cxx', help="Use this compiler for all envs")
+    args = parser.parse_args()
+
+    try:
+        from platformio.project.config import ProjectConfig
+    except ImportError:
+        print("Error: The PlatformIO Python package is required. Try 'pip install platformio'.")
+        sys.exit(1)
+
+    config = ProjectConfig()
+    envs = args.envs or config.envs()
+    Path(args.outdir).mkdir(parents=True, exist_ok=True)
+
+    # Gather the build flags and compiler for each env up front
+    jobs, compilers = [], {}
+    for pioenv in envs:
+        sect = 'env:' + pioenv
+        build_flags = config.get(sect, 'build_flags', [])
+        cxx = args.cxx or config.get(sect, 'custom_gcc', None)
+        if not cxx and not args.python:
+            platform = config.get(sect, 'platform', '')
+            if platform not in compilers: compilers[platform] = find_compiler(platform)
+            cxx = compilers[platform]
+        jobs.append((pioenv, build_flags, cxx, args.python, args.outdir))
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futures = [ pool.submit(extract_env, *job) for job in jobs ]
+        for future in as_completed(futures):
+            pioenv, outfile, info = future.result()
+            if outfile:
+                print(f"{pioenv}: {outfile} ({info})")
+            else:
+                print(f"{pioenv}: FAILED ({info})")
+                failed += 1
+
+    print(f"Extracted features for {len(jobs) - failed} of {len(jobs)} envs")
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
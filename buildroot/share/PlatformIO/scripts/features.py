@@ -0,0 +1,165 @@
+#
+# features.py
+# Parsed values and indexed queries of MARLIN_FEATURES, as used by common-dependencies.py
+#
+import re
+
+#
+# Parse the preprocessor's '#define NAME VALUE' lines into a dict of NAME => VALUE
+#
+def parse_define_list(define_list):
+    marlin_features = MarlinFeatures()
+    for define in define_list:
+        feature = define[8:].strip().decode().split(' ')
+        feature, definition = feature[0], ' '.join(feature[1:])
+        marlin_features[feature] = definition
+    return marlin_features
+
+#
+# Parse a define's value as a Python value:
+#   ''               => True (a plain "#define FEATURE")
+#   true, false      => bool
+#   123, 0x7F, 12UL  => int
+#   1.5, 2e3, 0.5f   => float
+#   "text"           => str, unquoted (escapes are left as-is)
+#   { 1, 2, { 3 } }  => list of parsed items
+# Anything else (expressions, names, etc.) is returned as the original string.
+#
+int_value = re.compile(r'^([-+]?)(0[xX][0-9a-fA-F]+|0[bB][01]+|0[0-7]*|[1-9]\d*)[uUlL]*$')
+float_value = re.compile(r'^[-+]?(\d+\.\d*|\.\d+|\d+(?=[eE]))([eE][-+]?\d+)?[fFlL]?$')
+
+# Split a list on top-level commas, ignoring commas in quotes and brackets
+def split_items(text):
+    items, depth, quote, escaped, start = [], 0, None, False, 0
+    for i, c in enumerate(text):
+        if quote:
+            if escaped: escaped = False
+            elif c == '\\': escaped = True
+            elif c == quote: quote = None
+        elif c in '"\'': quote = c
+        elif c in '({[': depth += 1
+        elif c in ')}]': depth -= 1
+        elif c == ',' and depth == 0:
+            items.append(text[start:i])
+            start = i + 1
+    items.append(text[start:])
+    return [ item.strip() for item in items if item.strip() ]
+
+# True if the outer parentheses enclose the whole value, as in '(1)' but not '(1)+(2)'
+def wrapped(val):
+    if not (val.startswith('(') and val.endswith(')')): return False
+    depth = 0
+    for c in val[:-1]:
+        depth += c == '('
+        depth -= c == ')'
+        if depth == 0: return False
+    return True
+
+def parse_value(text):
+    val = text.strip()
+    if val == '': return True
+    if val in ('true', 'false'): return val == 'true'
+    # Strip redundant parentheses, e.g., '(1)'
+    while wrapped(val): val = val[1:-1].strip()
+    m = int_value.match(val)
+    if m:
+        num = m[2]
+        if num[:2] in ('0x', '0X', '0b', '0B'): num = int(num, 0)
+        else: num = int(num, 8) if len(num) > 1 and num[0] == '0' else int(num)
+        return -num if m[1] == '-' else num
+    if float_value.match(val):
+        return float(val.rstrip('fFlL'))
+    if len(val) > 1 and val[0] == '"' and val[-1] == '"' and '"' not in val[1:-1].replace('\\"', ''):
+        return val[1:-1]
+    if val.startswith('{') and val.endswith('}'):
+        return [ parse_value(item) for item in split_items(val[1:-1]) ]
+    return text
+
+#
+# MARLIN_FEATURES is a dict of define name => raw value string, so existing
+# scripts keep working unchanged. Use value() to get a parsed value, which is
+# parsed only once, when first requested.
+#
+class MarlinFeatures(dict):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values = {}
+
+    def __setitem__(self, key, val):
+        super().__setitem__(key, val)
+        self.values.pop(key, None)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.values.pop(key, None)
+
+    # Get the parsed value of a define, or the default if the define is missing.
+    # With a type (e.g., int) also return the default if the value isn't of that type.
+    def value(self, name, default=None, type=None):
+        if name not in self:
+            return default
+        if name not in self.values:
+            self.values[name] = parse_value(self[name])
+        val = self.values[name]
+        if type is not None:
+            if not isinstance(val, type) or (isinstance(val, bool) and type is not bool):
+                return default
+        return val
+
+#
+# A feature query is a plain define name (e.g., 'NEOPIXEL_LED') or a regex
+# matched against the whole name (e.g., 'HAS_(FSMC|SPI|LTDC)_TFT').
+# Plain names are simple hash lookups. Each pattern is compiled once and
+# matched against all define names at once, joined into a single multi-line string.
+#
+plain_name = re.compile(r'^\w+$')
+
+class FeatureIndex:
+
+    def __init__(self, features:dict):
+        self.features = features
+        self.names = '\n'.join(features)
+        self.matches = {}   # query => matching define names
+        self.truth = {}     # define name => enabled
+        self.results = {}   # query => enabled
+
+    # Wrap a query the same way MarlinHas always has: '^' + query + '$'
+    # The lookahead keeps an alternation like 'A|B' matching as it did
+    # while the trailing '.*' captures the whole define name.
+    @staticmethod
+    def lookahead(query):
+        return f'(?:(?=(^{query}$)))'
+
+    def match(self, query):
+        if query not in self.matches:
+            if plain_name.match(query):
+                self.matches[query] = [ query ] if query in self.features else []
+            else:
+                patt = re.compile('^' + self.lookahead(query) + '.*$', re.M)
+                self.matches[query] = [ m[0] for m in patt.finditer(self.names) ]
+        return self.matches[query]
+
+    # A define is "on" if it's empty, 1, true, or the name of another enabled define.
+    # Each define has a single value, so an alias chain either ends or loops back on
+    # itself, in which case every define in the loop is "off".
+    def enabled(self, name, visiting=()):
+        if name not in self.truth:
+            val = self.features[name]
+            if val in ('', '1', 'true'):
+                self.truth[name] = True
+            elif val in self.features and val not in visiting + (name,):
+                self.truth[name] = self.has(val, visiting + (name,))
+            else:
+                self.truth[name] = False
+        return self.truth[name]
+
+    # Return True if any define matching the query is enabled
+    def has(self, query, visiting=()):
+        if query not in self.results:
+            self.results[query] = any(self.enabled(name, visiting) for name in self.match(query))
+        return self.results[query]
+
+    # Evaluate a list of queries, returning a dict of query => enabled
+    def has_all(self, queries):
+        return { q: self.has(q) for q in queries }
@@ -0,0 +1,233 @@
+#
+# fetch.py
+# Fetch configuration files over HTTP(S) with a local cache, as used by
+# configuration.py for 'ini_use_config = examples/...' and URLs
+#
+# Files are fetched by two workers sharing a pool of keep-alive connections,
+# so each connection serves several files. Fetched files are stored in the
+# cache by the hash of their contents, with an index of URL => ETag and content
+# hash. A cached file is revalidated with its ETag, so an unchanged file isn't
+# downloaded again. Files from a commit ('examples/path @ 1a2b3c4') never change, so once
+# cached they're used without asking the server at all.
+#
+# Environment variables:
+#   MARLIN_CONFIG_CACHE=<dir>    Cache folder (default .pio/config-cache)
+#   MARLIN_CONFIG_OFFLINE=1      Use only the cache or a mirror folder. No network.
+#   MARLIN_CONFIG_MIRROR=<dir>   A clone of MarlinFirmware/Configurations to use
+#                                instead of GitHub, with '<dir>/config/...' or
+#                                '<dir>/<branch>/config/...'
+#   MARLIN_CONFIG_MIRROR=<url>   A server to use instead of GitHub, with the same
+#                                '<url>/<branch>/config/...' layout, e.g., for tests
+#
+import os, re, json, hashlib, threading, http.client
+from pathlib import Path
+from urllib.parse import urlsplit, urljoin
+from concurrent.futures import ThreadPoolExecutor
+
+CONFIGS_URL = 'https://raw.githubusercontent.com/MarlinFirmware/Configurations'
+TIMEOUT = 30
+MAX_REDIRECTS = 5
+MAX_WORKERS = 2
+
+def cache_dir():
+    return Path(os.environ.get('MARLIN_CONFIG_CACHE') or Path('.pio', 'config-cache'))
+
+def offline():
+    return os.environ.get('MARLIN_CONFIG_OFFLINE', '') not in ('', '0')
+
+# A branch or tag can move, but a commit hash can't
+def is_commit(ref):
+    return re.match(r'^[0-9a-f]{7,40}$', ref) is not None
+
+#
+# The cache index maps each URL to { 'etag': ..., 'sha': ... }, with 'sha'
+# None for a file the server doesn't have. File contents are kept in
+# 'objects', named by their SHA-256.
+#
+class Cache:
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.index_file = self.folder / 'index.json'
+        try:
+            self.index = json.loads(self.index_file.read_text())
+        except (OSError, ValueError):
+            self.index = {}
+        self.changed = False
+        self.lock = threading.Lock()
+
+    def object_path(self, sha):
+        return self.folder / 'objects' / sha
+
+    # Return (found, data) for a URL, with data None for a cached "not found"
+    def get(self, url):
+        entry = self.index.get(url)
+        if entry is None: return False, None
+        if entry['sha'] is None: return True, None
+        try:
+            return True, self.object_path(entry['sha']).read_bytes()
+        except OSError:
+            return False, None
+
+    def etag(self, url):
+        entry = self.index.get(url)
+        return entry.get('etag') if entry else None
+
+    def put(self, url, data, etag=None):
+        sha = None
+        if data is not None:
+            sha = hashlib.sha256(data).hexdigest()
+            path = self.object_path(sha)
+            if not path.exists():
+                path.parent.mkdir(parents=True, exist_ok=True)
+                temp = path.with_name(f'{sha}.{os.getpid()}.{threading.get_ident()}')
+                temp.write_bytes(data)
+                os.replace(temp, path)
+        with self.lock:
+            self.index[url] = { 'etag': etag, 'sha': sha }
+            self.changed = True
+
+    # Write the index, if changed, by replacing it all at once
+    def save(self):
+        if not self.changed: return
+        try:
+            self.folder.mkdir(parents=True, exist_ok=True)
+            temp = self.index_file.with_name(f'index.{os.getpid()}.json')
+            temp.write_text(json.dumps(self.index, indent=0, sort_keys=True))
+            os.replace(temp, self.index_file)
+            self.changed = False
+        except OSError:
+            pass
+
+#
+# A pool of keep-alive connections by host. A worker takes an idle connection
+# (or opens a new one if none is idle) and gives it back after each request,
+# so there are never more connections than workers and each serves several files.
+#
+class ConnectionPool:
+
+    def __init__(self):
+        self.idle = {}      # (scheme, host) => [ connection, ... ]
+        self.all = []
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if self.idle.get(key): return self.idle[key].pop()
+        scheme, host = key
+        cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        conn = cls(host, timeout=TIMEOUT)
+        with self.lock: self.all.append(conn)
+        return conn
+
+    def put(self, key, conn):
+        with self.lock: self.idle.setdefault(key, []).append(conn)
+
+    def close(self):
+        with self.lock:
+            for conn in self.all: conn.close()
+            self.all, self.idle = [], {}
+
+# GET a URL, following redirects. Return (status, data, etag).
+def http_get(pool, url, etag=None):
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query: path += '?' + parts.query
+        headers = { 'User-Agent': 'Marlin-configuration.py' }
+        if etag: headers['If-None-Match'] = etag
+
+        # A kept-alive connection may have been closed by the server, so try a new one
+        while True:
+            conn = pool.get(key)
+            reused = conn.sock is not None
+            try:
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+                break
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                if not reused: raise
+        pool.put(key, conn)
+
+        if resp.status in (301, 302, 303, 307, 308) and resp.getheader('Location'):
+            url = urljoin(url, resp.getheader('Location'))
+            continue
+        return resp.status, data, resp.getheader('ETag')
+
+    raise http.client.HTTPException(f'Too many redirects for {url}')
+
+# Get a file by URL, from the cache or the server. Return its data, or None if
+# the server doesn't have it. Raise an OSError if it can't be had at all.
+def fetch_url(cache, pool, url, immutable=False):
+    found, data = cache.get(url)
+    if found and immutable: return data
+    if offline():
+        if found: return data
+        raise OSError(f'{url} is not in the cache (offline)')
+
+    try:
+        status, body, etag = http_get(pool, url, cache.etag(url) if found else None)
+    except (OSError, http.client.HTTPException) as exc:
+        # With no network use the cached copy, if any
+        if found: return data
+        raise OSError(f'{url}: {exc}')
+
+    if status == 304 and found:
+        return data
+    if status == 200:
+        cache.put(url, body, etag)
+        return body
+    if status in (404, 410):
+        cache.put(url, None)
+        return None
+    if found: return data
+    raise OSError(f'{url}: HTTP {status}')
+
+#
+# Fetch some files from a folder URL, MAX_WORKERS at a time. Return a dict of
+# filename => data for the files that exist, and a list of errors for the files
+# that couldn't be had. All connections are closed before returning.
+#
+def fetch_files(base_url, filenames, immutable=False):
+    cache, pool = Cache(cache_dir()), ConnectionPool()
+    found, errors = {}, []
+    def fetch_one(fn):
+        try:
+            return fn, fetch_url(cache, pool, f'{base_url}/{fn}', immutable)
+        except OSError as exc:
+            errors.append(str(exc))
+            return fn, None
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as workers:
+            for fn, data in workers.map(fetch_one, filenames):
+                if data is not None: found[fn] = data
+    finally:
+        pool.close()
+    cache.save()
+    return found, errors
+
+# Read some files from a local folder, as fetch_files does
+def read_files(folder, filenames):
+    found = {}
+    for fn in filenames:
+        fpath = Path(folder, fn)
+        if fpath.is_file(): found[fn] = fpath.read_bytes()
+    return found, []
+
+#
+# Fetch the files of an example configuration set, given its path in the
+# MarlinFirmware/Configurations 'config' folder and the branch, tag or commit.
+#
+def fetch_example(path, ref, filenames):
+    mirror = os.environ.get('MARLIN_CONFIG_MIRROR', '')
+    if mirror and not mirror.startswith('http'):
+        for folder in (Path(mirror, ref, 'config', path), Path(mirror, 'config', path)):
+            if folder.is_dir(): return read_files(folder, filenames)
+        return {}, [ f"No folder for '{path}' in {mirror}" ]
+
+    base = (mirror or CONFIGS_URL).rstrip('/')
+    url = f"{base}/{ref}/config/{path}".replace("%", "%25").replace(" ", "%20")
+    return fetch_files(url, filenames, is_commit(ref))
@@ -4,10 +4,12 @@
 #
 import shutil
 from pathlib import Path
+import profiler
 
 from SCons.Script import DefaultEnvironment
 env = DefaultEnvironment()
 
+@profiler.timed('copytree', 'variant')
 def copytree(src, dst, symlinks=False, ignore=None):
     for item in src.iterdir():
         if item.is_dir():
@@ -69,4 +71,4 @@ def encrypt_mks(source, target, env, new_name):
         fwpath.unlink()
 
 def add_post_action(action):
-    env.AddPostAction(str(Path("$BUILD_DIR", "${PROGNAME}.bin")), action);
+    env.AddPostAction(str(Path("$BUILD_DIR", "${PROGNAME}.bin")), profiler.timed_action(action));
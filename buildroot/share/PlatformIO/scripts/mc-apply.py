@@ -1,68 +1,129 @@
 #!/usr/bin/env python
 #
 # Create a Configuration from marlin_config.json
+# or directly from 'mc.zip' as written by 'M503 C'
 #
 import json
 import sys
 import shutil
+import zipfile
+
+#
+# Read 'marlin_config.json' or else the 'mc.zip' it came from.
+# 'mc.zip' is a zip file, or a heatshrink stream if it was built
+# with CONFIGURATION_EMBEDDING_CODEC HEATSHRINK.
+#
+def load_config():
+    try:
+        with open('marlin_config.json', 'r') as infile:
+            return json.load(infile)
+    except FileNotFoundError:
+        pass
+
+    with open('mc.zip', 'rb') as infile:
+        data = infile.read()
+
+    if data[:4] == b'MCHS':
+        try:
+            import heatshrink2 as heatshrink
+        except ImportError:
+            try:
+                import heatshrink
+            except ImportError:
+                print("This mc.zip is HEATSHRINK compressed. Try 'pip install heatshrink2'.")
+                sys.exit(1)
+        return json.loads(heatshrink.decode(data[6:], window_sz2=data[4], lookahead_sz2=data[5]))
+
+    with zipfile.ZipFile('mc.zip') as zipf:
+        return json.loads(zipf.read('marlin_config.json'))
+
+#
+# Restore the full configuration from a CONFIGURATION_EMBEDDING_DELTA build,
+# which only has the options that differ from the stock configuration
+#
+def expand_config(conf):
+    version = conf.pop('__DEFAULTS', None)
+    if version is None:
+        return conf
+    removed = conf.pop('__REMOVED', {})
+
+    defaults_file = 'buildroot/share/PlatformIO/config-defaults/' + version + '.json'
+    try:
+        with open(defaults_file, 'r') as infile:
+            defaults = json.load(infile)
+    except FileNotFoundError:
+        print('This configuration needs ' + defaults_file + ' from Marlin ' + conf.get('VERSION', {}).get('DETAILED_BUILD_VERSION', version) + '.')
+        sys.exit(1)
+
+    for key, opts in defaults.items():
+        full = { k: v for k, v in opts.items() if k not in removed.get(key, ()) }
+        full.update(conf.get(key, {}))
+        conf[key] = full
+    return conf
 
 opt_output = '--opt' in sys.argv
 output_suffix = '.sh' if opt_output else '' if '--bare-output' in sys.argv else '.gen'
 
 try:
-    with open('marlin_config.json', 'r') as infile:
-        conf = json.load(infile)
-        for key in conf:
-            # We don't care about the hash when restoring here
-            if key == '__INITIAL_HASH':
-                continue
-            if key == 'VERSION':
-                for k, v in sorted(conf[key].items()):
-                    print(k + ': ' + v)
-                continue
-            # The key is the file name, so let's build it now
-            outfile = open('Marlin/' + key + output_suffix, 'w')
+    conf = load_config()
+except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+    print('No marlin_config.json or mc.zip found.')
+    sys.exit(1)
+
+conf = expand_config(conf)
+
+try:
+    for key in conf:
+        # We don't care about the hash when restoring here
+        if key == '__INITIAL_HASH':
+            continue
+        if key == 'VERSION':
             for k, v in sorted(conf[key].items()):
-                # Make define line now
-                if opt_output:
-                    if v != '':
-                        if '"' in v:
-                            v = "'%s'" % v
-                        elif ' ' in v:
-                            v = '"%s"' % v
-                        define = 'opt_set ' + k + ' ' + v + '\n'
-                    else:
-                        define = 'opt_enable ' + k + '\n'
+                print(k + ': ' + v)
+            continue
+        # The key is the file name, so let's build it now
+        outfile = open('Marlin/' + key + output_suffix, 'w')
+        for k, v in sorted(conf[key].items()):
+            # Make define line now
+            if opt_output:
+                if v != '':
+                    if '"' in v:
+                        v = "'%s'" % v
+                    elif ' ' in v:
+                        v = '"%s"' % v
+                    define = 'opt_set ' + k + ' ' + v + '\n'
                 else:
-                    define = '#define ' + k + ' ' + v + '\n'
-                outfile.write(define)
-            outfile.close()
+                    define = 'opt_enable ' + k + '\n'
+            else:
+                define = '#define ' + k + ' ' + v + '\n'
+            outfile.write(define)
+        outfile.close()
 
-            # Try to apply changes to the actual configuration file (in order to keep useful comments)
-            if output_suffix != '':
-                # Move the existing configuration so it doesn't interfere
-                shutil.move('Marlin/' + key, 'Marlin/' + key + '.orig')
-                infile_lines = open('Marlin/' + key + '.orig', 'r').read().split('\n')
-                outfile = open('Marlin/' + key, 'w')
-                for line in infile_lines:
-                    sline = line.strip(" \t\n\r")
-                    if sline[:7] == "#define":
-                        # Extract the key here (we don't care about the value)
-                        kv = sline[8:].strip().split(' ')
-                        if kv[0] in conf[key]:
-                            outfile.write('#define ' + kv[0] + ' ' + conf[key][kv[0]] + '\n')
-                            # Remove the key from the dict, so we can still write all missing keys at the end of the file
-                            del conf[key][kv[0]]
-                        else:
-                            outfile.write(line + '\n')
+        # Try to apply changes to the actual configuration file (in order to keep useful comments)
+        if output_suffix != '':
+            # Move the existing configuration so it doesn't interfere
+            shutil.move('Marlin/' + key, 'Marlin/' + key + '.orig')
+            infile_lines = open('Marlin/' + key + '.orig', 'r').read().split('\n')
+            outfile = open('Marlin/' + key, 'w')
+            for line in infile_lines:
+                sline = line.strip(" \t\n\r")
+                if sline[:7] == "#define":
+                    # Extract the key here (we don't care about the value)
+                    kv = sline[8:].strip().split(' ')
+                    if kv[0] in conf[key]:
+                        outfile.write('#define ' + kv[0] + ' ' + conf[key][kv[0]] + '\n')
+                        # Remove the key from the dict, so we can still write all missing keys at the end of the file
+                        del conf[key][kv[0]]
                     else:
                         outfile.write(line + '\n')
-                # Process any remaining defines here
-                for k, v in sorted(conf[key].items()):
-                    define = '#define ' + k + ' ' + v + '\n'
-                    outfile.write(define)
-                outfile.close()
+                else:
+                    outfile.write(line + '\n')
+            # Process any remaining defines here
+            for k, v in sorted(conf[key].items()):
+                define = '#define ' + k + ' ' + v + '\n'
+                outfile.write(define)
+            outfile.close()
 
-            print('Output configuration written to: ' + 'Marlin/' + key + output_suffix)
+        print('Output configuration written to: ' + 'Marlin/' + key + output_suffix)
 except:
-    print('No marlin_config.json found.')
+    print('No marlin_config.json or mc.zip found.')
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+#
+# mc-defaults.py
+#
+# Make the snapshot of the stock configuration used by CONFIGURATION_EMBEDDING_DELTA.
+# Build the stock configuration with CONFIG_EXPORT 1, then run this from the root
+# of the Marlin repo with the exported file, e.g.:
+#
+#   mc-defaults.py .pio/build/mega2560/marlin_config.json
+#
+# This writes buildroot/share/PlatformIO/config-defaults/<CONFIGURATION_H_VERSION>.json.
+# Make a new snapshot for each new CONFIGURATION_H_VERSION and keep the old ones,
+# so mc-apply.py can still restore configurations embedded by older firmware.
+#
+import sys, json
+from pathlib import Path
+
+DEFAULTS_DIR = Path('buildroot/share/PlatformIO/config-defaults')
+
+# Options that are set for the export but aren't stock
+ignore = ('CONFIG_EXPORT',)
+
+def main():
+    if len(sys.argv) != 2:
+        print(f"Usage: {Path(sys.argv[0]).name} marlin_config.json")
+        sys.exit(1)
+
+    conf = json.loads(Path(sys.argv[1]).read_text())
+    if '__DEFAULTS' in conf:
+        print("Error: This is a CONFIGURATION_EMBEDDING_DELTA export. Build without it.")
+        sys.exit(1)
+
+    defaults = {}
+    for header, opts in conf.items():
+        if header.startswith('__') or header == 'VERSION': continue
+        defaults[header] = { k: v for k, v in opts.items() if k not in ignore }
+
+    version = defaults['Configuration.h']['CONFIGURATION_H_VERSION']
+    outfile = DEFAULTS_DIR / f'{version}.json'
+    outfile.parent.mkdir(parents=True, exist_ok=True)
+    outfile.write_text(json.dumps(defaults, indent=2, sort_keys=True) + '\n')
+    print(f"Configuration defaults written to {outfile}")
+
+if __name__ == '__main__':
+    main()
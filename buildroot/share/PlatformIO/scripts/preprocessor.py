@@ -1,20 +1,114 @@
 #
 # preprocessor.py
 #
-import subprocess
+import subprocess,re,os,json,hashlib,shutil
+from pathlib import Path
+import profiler
 
-nocache = 1
+nocache = 0
 verbose = 0
 
 def blab(str):
     if verbose:
         print(str)
 
+################################################################################
+#
+# Persistent cache of preprocessor results, kept in the env build folder
+# so that a no-op rebuild doesn't need to spawn the compiler again.
+#
+# The key covers the configuration headers, the full command line (compiler
+# path and all CPPDEFINES) and the compiler version. The entry stays valid as
+# long as no header pulled in by the preprocessor has a different mtime.
+#
+CONFIG_HEADERS = ('Marlin/Configuration.h', 'Marlin/Configuration_adv.h')
+
+def build_path(env):
+    return Path(env['PROJECT_BUILD_DIR'], env['PIOENV'])
+
+def preprocessor_key(env, cmd, cxx):
+    sha = hashlib.sha256()
+    for header in CONFIG_HEADERS:
+        try:
+            sha.update(Path(header).read_bytes())
+        except OSError:
+            pass
+    sha.update(cmd.encode())
+    sha.update(compiler_version(env, cxx).encode())
+    return sha.hexdigest()
+
+# Parse a Make-style dependency file as written by 'gcc -MD -MF'
+def parse_depfile(depfile):
+    text = depfile.read_text().replace('\\\n', ' ')
+    text = text[text.find(': ') + 2:]
+    deps = [ dep.replace('\\ ', ' ') for dep in re.split(r'(?<!\\)\s+', text.strip()) if dep ]
+    return [ os.path.normpath(dep) for dep in deps ]
+
+# Get the mtimes of all headers, or None if any is missing
+def header_mtimes(deps):
+    mtimes = {}
+    for dep in deps:
+        try:
+            mtimes[dep] = os.stat(dep).st_mtime_ns
+        except OSError:
+            return None
+    return mtimes
+
+def load_cached_defines(cache_file, filename, key):
+    try:
+        entry = json.loads(cache_file.read_text())[filename]
+    except:
+        return None
+    if entry['key'] != key or header_mtimes(entry['deps']) != entry['deps']:
+        return None
+    blab("Using cached preprocessor output for %s" % filename)
+    preprocessor_deps[filename] = list(entry['deps'])
+    return [ line.encode() for line in entry['defines'] ]
+
+def save_cached_defines(cache_file, filename, key, deps, define_list):
+    preprocessor_deps[filename] = deps
+    mtimes = header_mtimes(deps)
+    if mtimes is None: return
+    try:
+        cache = json.loads(cache_file.read_text())
+    except:
+        cache = {}
+    cache[filename] = { 'key': key, 'deps': mtimes, 'defines': [ line.decode() for line in define_list ] }
+    cache_file.write_text(json.dumps(cache))
+
+################################################################################
+#
+# Header dependencies of the preprocessed file, the same list 'gcc -M' gives.
+# This is the exact invalidation set for MARLIN_FEATURES: every project header
+# (Marlin/src/inc, pins, configs...) that was actually included.
+#
+preprocessor_deps = {}
+def get_dependencies(env, fn=None):
+    filename = fn or 'buildroot/share/PlatformIO/scripts/common-dependencies.h'
+    run_preprocessor(env, fn)
+    return [ dep for dep in preprocessor_deps.get(filename, []) if not os.path.isabs(dep) and not dep.startswith('..') ]
+
+# A hash of the current state of all dependencies. Downstream consumers
+# can store this and skip work when none of the headers has changed,
+# as compute_build_signature does.
+def dependency_stamp(env, fn=None):
+    mtimes = header_mtimes(get_dependencies(env, fn)) or {}
+    return hashlib.sha256(json.dumps(mtimes, sort_keys=True).encode()).hexdigest()
+
+# Write the dependency manifest (header => mtime) to the env build folder
+def write_dependency_manifest(env, fn=None):
+    mtimes = header_mtimes(get_dependencies(env, fn)) or {}
+    manifest = build_path(env) / "marlin_deps.json"
+    manifest.parent.mkdir(parents=True, exist_ok=True)
+    manifest.write_text(json.dumps(mtimes, indent=2, sort_keys=True))
+    return manifest
+
 ################################################################################
 #
 # Invoke GCC to run the preprocessor and extract enabled features
 #
 preprocessor_cache = {}
+@profiler.timed('run_preprocessor', 'preprocessor')
 def run_preprocessor(env, fn=None):
     filename = fn or 'buildroot/share/PlatformIO/scripts/common-dependencies.h'
     if filename in preprocessor_cache:
@@ -39,25 +133,123 @@ def run_preprocessor(env, fn=None):
     cmd += ['-D__MARLIN_DEPS__ -w -dM -E -x c++']
     depcmd = cmd + [ filename ]
     cmd = ' '.join(depcmd)
+
+    # Use the on-disk cache if nothing has changed
+    env_build_path = build_path(env)
+    cache_file = env_build_path / "marlin_preprocessor.json"
+    key = preprocessor_key(env, cmd, cxx)
+    define_list = load_cached_defines(cache_file, filename, key)
+    if define_list is not None:
+        preprocessor_cache[filename] = define_list
+        return define_list
+
+    # Have the preprocessor list all the included headers too
+    env_build_path.mkdir(parents=True, exist_ok=True)
+    depfile = env_build_path / "marlin_preprocessor.d"
+    cmd += ' -MD -MF "%s"' % depfile
+
     blab(cmd)
     try:
         define_list = subprocess.check_output(cmd, shell=True).splitlines()
     except:
         define_list = {}
+    else:
+        save_cached_defines(cache_file, filename, key, parse_depfile(depfile), define_list)
     preprocessor_cache[filename] = define_list
     return define_list
 
 
 ################################################################################
 #
-# Find a compiler, considering the OS
+# Registry of the compilers found for each toolchain package, shared by all
+# envs in .pio/build. An entry is only used while the binary has the same
+# inode, size and mtime, so a newly-installed toolchain is picked up. The
+# compiler version and builtin defines are memoized in the same entry.
 #
-def search_compiler(env):
+compiler_registry = None
 
-    from pathlib import Path, PurePath
+def registry_path(env):
+    return Path(env['PROJECT_BUILD_DIR'], "marlin_compilers.json")
 
-    ENV_BUILD_PATH = Path(env['PROJECT_BUILD_DIR'], env['PIOENV'])
-    GCC_PATH_CACHE = ENV_BUILD_PATH / ".gcc_path"
+def load_registry(env):
+    global compiler_registry
+    if compiler_registry is None:
+        try:
+            compiler_registry = json.loads(registry_path(env).read_text())
+        except:
+            compiler_registry = {}
+    return compiler_registry
+
+def save_registry(env):
+    rpath = registry_path(env)
+    try:
+        rpath.parent.mkdir(parents=True, exist_ok=True)
+        # Each env and worker process writes its own temp file, then replaces the registry
+        tmp = rpath.with_name(f'{rpath.stem}.{os.getpid()}.tmp')
+        tmp.write_text(json.dumps(compiler_registry, indent=2))
+        tmp.replace(rpath)
+    except OSError:
+        pass
+
+def binary_signature(path):
+    path = shutil.which(path) or path
+    try:
+        st = os.stat(path)
+        return [ st.st_ino, st.st_size, st.st_mtime_ns ]
+    except OSError:
+        return None
+
+# Get the entry for a toolchain package (or compiler path) if it's still valid
+def registry_entry(env, key):
+    entry = load_registry(env).get(key)
+    if entry and entry['sig'] is not None and entry['sig'] == binary_signature(entry['path']):
+        return entry
+    return None
+
+def register_compiler(env, key, path):
+    load_registry(env)[key] = { 'path': path, 'sig': binary_signature(path) }
+    save_registry(env)
+    return compiler_registry[key]
+
+def compiler_entry(env, cxx):
+    key = next((k for k, e in load_registry(env).items() if e['path'] == cxx), cxx)
+    return registry_entry(env, key) or register_compiler(env, key, cxx)
+
+# Get a memoized compiler property, computing it on first use
+def compiler_memo(env, cxx, prop, compute):
+    entry = compiler_entry(env, cxx)
+    if prop not in entry:
+        entry[prop] = compute()
+        if entry['sig'] is not None: save_registry(env)
+    return entry[prop]
+
+def compiler_version(env, cxx):
+    def get_version():
+        try:
+            return subprocess.check_output([cxx, '-dumpfullversion', '-dumpversion']).decode().strip()
+        except:
+            return ''
+    return compiler_memo(env, cxx, 'version', get_version)
+
+# The compiler's own predefined macros, as NAME => VALUE
+def compiler_builtins(env, cxx):
+    def get_builtins():
+        try:
+            lines = subprocess.check_output([cxx, '-w', '-dM', '-E', '-x', 'c++', os.devnull]).decode().splitlines()
+        except:
+            return {}
+        builtins = {}
+        for line in lines:
+            key_val = line[8:].strip().split(' ')
+            builtins[key_val[0]] = ' '.join(key_val[1:])
+        return builtins
+    return compiler_memo(env, cxx, 'builtins', get_builtins)
+
+################################################################################
+#
+# Find a compiler, considering the OS
+#
+def search_compiler(env):
 
     try:
         gccpath = env.GetProjectOption('custom_gcc')
@@ -66,11 +258,6 @@ def search_compiler(env):
     except:
         pass
 
-    # Warning: The cached .gcc_path will obscure a newly-installed toolkit
-    if not nocache and GCC_PATH_CACHE.exists():
-        blab("Getting g++ path from cache")
-        return GCC_PATH_CACHE.read_text()
-
     # Use any item in $PATH corresponding to a platformio toolchain bin folder
     path_separator = ':'
     gcc_exe = '*g++'
@@ -81,12 +268,23 @@ def search_compiler(env):
     # Search for the compiler in PATH
     for ppath in map(Path, env['ENV']['PATH'].split(path_separator)):
         if ppath.match(env['PROJECT_PACKAGES_DIR'] + "/**/bin"):
+            # The toolchain package name is the registry key
+            try:
+                pkg = ppath.relative_to(env['PROJECT_PACKAGES_DIR']).parts[0]
+            except ValueError:
+                pkg = str(ppath)
+
+            if not nocache:
+                entry = registry_entry(env, pkg)
+                if entry:
+                    blab("Getting g++ path from the compiler registry")
+                    return entry['path']
+
             for gpath in ppath.glob(gcc_exe):
                 gccpath = str(gpath.resolve())
-                # Cache the g++ path to no search always
-                if not nocache and ENV_BUILD_PATH.exists():
-                    blab("Caching g++ for current env")
-                    GCC_PATH_CACHE.write_text(gccpath)
+                if not nocache:
+                    blab("Adding g++ for %s to the compiler registry" % pkg)
+                    register_compiler(env, pkg, gccpath)
                 return gccpath
 
     gccpath = env.get('CXX')
@@ -0,0 +1,111 @@
+#
+# profiler.py
+# Opt-in timing of the Marlin build scripts
+#
+# Enable with MARLIN_PROFILE=1 in the shell environment or 'custom_profile = yes'
+# in the env's ini section. At exit a Chrome trace (for chrome://tracing or
+# https://ui.perfetto.dev) is written to .pio/build/<env>/marlin_profile.json
+# and a summary of the time spent in each span is printed.
+#
+# Usage:
+#   with profiler.span('apply_config_ini'): ...
+#   @profiler.timed('run_preprocessor')
+#   env.AddPostAction(target, profiler.timed_action(action))
+#
+import os, time, json, atexit, threading, functools
+from pathlib import Path
+from contextlib import contextmanager
+
+events = []
+enabled = None
+pid = os.getpid()
+
+def project_env():
+    try:
+        from SCons.Script import DefaultEnvironment
+        env = DefaultEnvironment()
+        return env if 'PIOENV' in env else None
+    except:
+        return None
+
+def is_enabled():
+    global enabled
+    if enabled is None:
+        enabled = os.environ.get('MARLIN_PROFILE', '') not in ('', '0')
+        if not enabled:
+            env = project_env()
+            try:
+                enabled = str(env.GetProjectOption('custom_profile', '')).lower() in ('1', 'yes', 'true', 'on')
+            except:
+                enabled = False
+        if enabled:
+            atexit.register(report)
+    return enabled
+
+def now_us():
+    return time.perf_counter_ns() // 1000
+
+#
+# Time a block as a Chrome trace "complete" event
+#
+@contextmanager
+def span(name, cat='script', **args):
+    if not is_enabled():
+        yield
+        return
+    start = now_us()
+    try:
+        yield
+    finally:
+        event = { 'name': name, 'cat': cat, 'ph': 'X', 'ts': start, 'dur': now_us() - start, 'pid': pid, 'tid': threading.get_ident() }
+        if args: event['args'] = { k: str(v) for k, v in args.items() }
+        events.append(event)
+
+#
+# Decorator to time every call of a function
+#
+def timed(name=None, cat='function'):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name or fn.__name__, cat):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+#
+# Wrap an SCons action function (source, target, env) to time it
+#
+def timed_action(action, name=None):
+    if not is_enabled() or not callable(action):
+        return action
+    return timed(name or getattr(action, '__name__', 'post_action'), 'post_action')(action)
+
+def summary():
+    totals = {}
+    for e in events:
+        key = (e['cat'], e['name'])
+        count, total, longest = totals.get(key, (0, 0, 0))
+        totals[key] = (count + 1, total + e['dur'], max(longest, e['dur']))
+    return sorted(totals.items(), key=lambda t: -t[1][1])
+
+def report():
+    if not events:
+        return
+    env = project_env()
+    name = env['PIOENV'] if env else str(pid)
+
+    print()
+    print(f"Marlin build script profile for {name}")
+    print(f"{'Category':<12} {'Name':<48} {'Calls':>6} {'Total ms':>10} {'Max ms':>10}")
+    for (cat, name_), (count, total, longest) in summary():
+        print(f"{cat:<12} {name_:<48} {count:>6} {total / 1000:>10.1f} {longest / 1000:>10.1f}")
+
+    if env:
+        path = Path(env['PROJECT_BUILD_DIR'], env['PIOENV'], 'marlin_profile.json')
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(json.dumps({ 'traceEvents': events, 'displayTimeUnit': 'ms' }))
+            print(f"Chrome trace written to {path}")
+        except OSError as exc:
+            print(f"Can't write {path}: {exc}")
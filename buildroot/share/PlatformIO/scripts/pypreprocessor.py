@@ -0,0 +1,681 @@
+#!/usr/bin/env python3
+#
+# pypreprocessor.py
+#
+# A pure-Python subset of the C preprocessor, enough to resolve Marlin features
+# without a cross toolchain. It handles #define/#undef, #if/#ifdef/#ifndef/#elif/
+# #else/#endif and #include, with full macro expansion in #if expressions.
+# ENABLED(), DISABLED(), ANY(), ALL(), NONE(), BOTH(), EITHER(), COUNT_ENABLED()
+# and PIN_EXISTS() are evaluated directly instead of through the macros.h tricks.
+#
+# The result is the same define map as 'preprocessor.run_preprocessor', minus
+# the compiler's own builtin defines unless those are provided. Use --check to
+# compare the result against the output of a real compiler.
+#
+# Usage: pypreprocessor.py [-DNAME[=VAL]]... [-IDIR]... [--builtins FILE]
+#                          [--cxx CXX [--check]] [--json] [FILE]
+#
+import re, os, json
+from pathlib import Path
+
+#
+# Tokens
+#
+tokgrep = re.compile(r'''
+     (?P<ws>\s+)
+    |(?P<num>\.?\d(?:[eEpP][-+]|[\w.])*)
+    |(?P<id>[A-Za-z_$][\w$]*)
+    |(?P<str>"(?:\\.|[^"\\\n])*")
+    |(?P<chr>'(?:\\.|[^'\\\n])*')
+    |(?P<punct>%:%:|\.\.\.|<<=|>>=|->|\+\+|--|<<|>>|<=|>=|==|!=|&&|\|\||[-+*/%&|^]=|\#\#|::|%:|[][(){}.,;:?~!<>=+\-*/%&|^\#])
+    |(?P<other>.)
+''', re.X | re.S)
+
+commgrep = re.compile(r'//[^\n]*|/\*.*?\*/|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'', re.S)
+dirgrep = re.compile(r'^\s*(?:#|%:)\s*([a-z_]+)\b\s*(.*)$')
+defgrep = re.compile(r'^([A-Za-z_$][\w$]*)(\(([^)]*)\))?\s*(.*)$', re.S)
+
+class Token:
+    __slots__ = ('kind', 'text', 'space', 'hide')
+    def __init__(self, kind, text, space=False, hide=frozenset()):
+        self.kind, self.text, self.space, self.hide = kind, text, space, hide
+
+    def copy(self, space=None, hide=None):
+        return Token(self.kind, self.text, self.space if space is None else space, self.hide if hide is None else hide)
+
+    def __repr__(self):
+        return self.text
+
+def tokenize(text):
+    toks, space = [], False
+    for m in tokgrep.finditer(text):
+        kind = m.lastgroup
+        if kind == 'ws':
+            space = True
+        else:
+            toks.append(Token(kind, m.group(), space))
+            space = False
+    return toks
+
+# Token text as printed by 'gcc -dM', with a single space wherever there was whitespace
+def detokenize(toks):
+    return ''.join((' ' if t.space and i else '') + t.text for i, t in enumerate(toks))
+
+def stringify(toks):
+    text = detokenize(toks)
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+class PreprocessorError(Exception):
+    pass
+
+#
+# Expression compiler for #if and similar expressions. Produces a Python
+# closure taking a context argument. Leaves (numbers, identifiers and
+# function-style calls) are compiled by the given callbacks, so the same
+# parser can be used with fully-expanded tokens or raw expressions.
+#
+binary_ops = {
+    '*': (10, lambda a, b: a * b),
+    '/': (10, lambda a, b: c_div(a, b)),
+    '%': (10, lambda a, b: a - c_div(a, b) * b),
+    '+': (9, lambda a, b: a + b),
+    '-': (9, lambda a, b: a - b),
+    '<<': (8, lambda a, b: a << b),
+    '>>': (8, lambda a, b: a >> b),
+    '<': (7, lambda a, b: int(a < b)),
+    '<=': (7, lambda a, b: int(a <= b)),
+    '>': (7, lambda a, b: int(a > b)),
+    '>=': (7, lambda a, b: int(a >= b)),
+    '==': (6, lambda a, b: int(a == b)),
+    '!=': (6, lambda a, b: int(a != b)),
+    '&': (5, lambda a, b: a & b),
+    '^': (4, lambda a, b: a ^ b),
+    '|': (3, lambda a, b: a | b),
+    '&&': (2, None),
+    '||': (1, None)
+}
+
+def c_div(a, b):
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+def parse_number(text):
+    text = text.rstrip('uUlL')
+    if text.lower().startswith('0x'): return int(text, 16)
+    if text.lower().startswith('0b'): return int(text, 2)
+    if len(text) > 1 and text.startswith('0'): return int(text, 8)
+    return int(text)
+
+def parse_char(text):
+    body = text[1:-1]
+    if body.startswith('\\'):
+        esc = { 'n':10, 't':9, 'r':13, '0':0, '\\':92, "'":39, '"':34, 'a':7, 'b':8, 'f':12, 'v':11 }
+        if body[1] == 'x': return int(body[2:], 16)
+        if body[1:].isdigit(): return int(body[1:], 8)
+        return esc.get(body[1], ord(body[1]))
+    return ord(body) if len(body) == 1 else 0
+
+class ExprCompiler:
+
+    def __init__(self, toks, leaf, call):
+        self.toks, self.pos, self.leaf, self.call = toks, 0, leaf, call
+
+    def peek(self):
+        return self.toks[self.pos].text if self.pos < len(self.toks) else None
+
+    def take(self, text=None):
+        if self.pos >= len(self.toks):
+            raise PreprocessorError("unexpected end of expression")
+        t = self.toks[self.pos]
+        if text is not None and t.text != text:
+            raise PreprocessorError(f"expected '{text}' but got '{t.text}'")
+        self.pos += 1
+        return t
+
+    def compile(self):
+        fn = self.ternary()
+        if self.pos < len(self.toks):
+            raise PreprocessorError(f"unexpected '{self.toks[self.pos].text}' in expression")
+        return fn
+
+    def ternary(self):
+        cond = self.binary(1)
+        if self.peek() != '?': return cond
+        self.take('?')
+        a = self.ternary()
+        self.take(':')
+        b = self.ternary()
+        return lambda c: a(c) if cond(c) else b(c)
+
+    def binary(self, minprec):
+        lhs = self.unary()
+        while True:
+            op = self.peek()
+            if op not in binary_ops or binary_ops[op][0] < minprec: return lhs
+            self.take()
+            prec, fn = binary_ops[op]
+            rhs = self.binary(prec + 1)
+            if op == '&&':
+                lhs = (lambda l, r: lambda c: int(bool(l(c)) and bool(r(c))))(lhs, rhs)
+            elif op == '||':
+                lhs = (lambda l, r: lambda c: int(bool(l(c)) or bool(r(c))))(lhs, rhs)
+            else:
+                lhs = (lambda l, r, f: lambda c: f(l(c), r(c)))(lhs, rhs, fn)
+
+    def unary(self):
+        op = self.peek()
+        if op in ('!', '-', '+', '~'):
+            self.take()
+            v = self.unary()
+            if op == '!': return lambda c: int(not v(c))
+            if op == '-': return lambda c: -v(c)
+            if op == '~': return lambda c: ~v(c)
+            return v
+        return self.primary()
+
+    def primary(self):
+        t = self.take()
+        if t.text == '(':
+            v = self.ternary()
+            self.take(')')
+            return v
+        if t.kind == 'id':
+            if self.peek() == '(':
+                self.take('(')
+                depth, start = 0, self.pos
+                while True:
+                    p = self.take().text
+                    if p == '(': depth += 1
+                    elif p == ')':
+                        if depth == 0: break
+                        depth -= 1
+                return self.call(t.text, self.toks[start:self.pos - 1])
+            if t.text == 'defined' and self.peek() is not None:
+                return self.call(t.text, [ self.take() ])
+        return self.leaf(t)
+
+def compile_expr(toks, leaf, call):
+    return ExprCompiler(toks, leaf, call).compile()
+
+# Leaves for expressions that have already been fully expanded
+def const_leaf(t):
+    if t.kind == 'num':
+        try:
+            v = parse_number(t.text)
+        except ValueError:
+            raise PreprocessorError(f"invalid integer constant '{t.text}'")
+    elif t.kind == 'chr':
+        v = parse_char(t.text)
+    elif t.kind == 'id':
+        v = 1 if t.text == 'true' else 0
+    else:
+        raise PreprocessorError(f"unexpected '{t.text}' in expression")
+    return lambda c: v
+
+def const_call(name, args):
+    raise PreprocessorError(f"function-like macro '{name}' is not defined")
+
+#
+# The value of a define counts as "enabled" like the ENABLED() macro says
+#
+enabled_values = ('', '1', '0x1', 'true')
+
+# Operators that the compiler itself treats as defined
+builtin_specials = ('__has_include', '__has_include_next', '__has_attribute', '__has_cpp_attribute', '__has_builtin')
+
+class Macro:
+    __slots__ = ('name', 'params', 'variadic', 'body', 'pindex')
+    def __init__(self, name, params, variadic, body):
+        self.name, self.params, self.variadic, self.body = name, params, variadic, body
+        self.pindex = { p: i for i, p in enumerate(params) } if params is not None else {}
+
+    # The key and value as printed by 'gcc -dM'
+    def key(self):
+        if self.params is None: return self.name
+        params = list(self.params)
+        if self.variadic:
+            params[-1] = '...' if params[-1] == '__VA_ARGS__' else params[-1] + '...'
+        return f"{self.name}({','.join(params)})"
+
+    # gcc prints a space ahead of each '##'
+    def value(self):
+        return ''.join((' ' if (t.space or t.text == '##') and i else '') + t.text for i, t in enumerate(self.body))
+
+class Preprocessor:
+
+    def __init__(self, include_dirs=(), defines=None):
+        self.include_dirs = [ Path(d) for d in include_dirs ]
+        self.macros = {}
+        self.pragma_once = set()
+        self.errors = []
+        self.depth = 0
+        self.curdir = Path('.')
+        self.arg_cache = {}
+        for name, value in (defines or {}).items():
+            self.define(name, value)
+
+    #
+    # Define a macro from a command line style NAME / NAME=VALUE pair
+    #
+    def define(self, name, value='1'):
+        self.define_line(f'{name} {value}')
+
+    def define_line(self, text):
+        m = defgrep.match(text.strip())
+        if not m: raise PreprocessorError(f"invalid #define '{text}'")
+        name, params, variadic = m[1], None, False
+        if m[2] is not None:
+            params = [ p.strip() for p in m[3].split(',') ] if m[3].strip() else []
+            if params and params[-1].endswith('...'):
+                variadic = True
+                params[-1] = params[-1][:-3].strip() or '__VA_ARGS__'
+        body = tokenize(m[4])
+        if body: body[0].space = False
+        self.macros[name] = Macro(name, params, variadic, body)
+        self.arg_cache.clear()
+
+    def undef(self, name):
+        self.macros.pop(name, None)
+        self.arg_cache.clear()
+
+    #
+    # The resulting define map, as would be parsed from 'gcc -dM' output
+    #
+    def define_map(self):
+        return { m.key(): m.value() for m in self.macros.values() }
+
+    def define_lines(self):
+        return [ f'#define {k} {v}'.encode() for k, v in self.define_map().items() ]
+
+    #
+    # Macro expansion
+    #
+    def expand(self, toks, in_if=False):
+        out = []
+        stack = list(reversed(toks))
+        while stack:
+            t = stack.pop()
+            if t.kind != 'id':
+                out.append(t)
+                continue
+            name = t.text
+            if in_if:
+                if name == 'defined':
+                    out.append(self.eval_defined(stack, t.space))
+                    continue
+                if name in builtin_specials and stack and stack[-1].text == '(':
+                    args, _ = self.collect_args(stack)
+                    # Assume the compiler has any attribute or builtin asked about
+                    has = self.has_include(args) if name.startswith('__has_include') else int(args != [[]])
+                    out.append(Token('num', str(has), t.space))
+                    continue
+                if name in intrinsics and stack and stack[-1].text == '(':
+                    args, _ = self.collect_args(stack)
+                    out.append(Token('num', str(intrinsics[name](self, args)), t.space))
+                    continue
+            m = self.macros.get(name)
+            if m is None or name in t.hide:
+                out.append(t)
+                continue
+            if m.params is None:
+                repl = self.substitute(m, None, t.hide | {name}, in_if)
+            else:
+                if not stack or stack[-1].text != '(':
+                    out.append(t)
+                    continue
+                args, rparen = self.collect_args(stack)
+                if args is None:
+                    out.append(t)
+                    continue
+                repl = self.substitute(m, args, (t.hide & rparen.hide) | {name}, in_if)
+            if repl: repl[0] = repl[0].copy(space=t.space)
+            stack.extend(reversed(repl))
+        return out
+
+    #
+    # Expand a macro argument on its own. Results with no macro names left in them
+    # are cached, since the hide sets of their tokens can no longer matter. This
+    # keeps wrappers like EVAL1024(V) from expanding the same thing many times.
+    #
+    def expand_arg(self, toks, in_if):
+        macros = self.macros
+        key = (in_if,) + tuple((t.text, t.text in t.hide) if t.text in macros else t.text for t in toks)
+        res = self.arg_cache.get(key)
+        if res is None:
+            res = self.expand(toks, in_if)
+            if not any(t.text in macros for t in res if t.kind == 'id'):
+                self.arg_cache[key] = res
+        return res
+
+    def eval_defined(self, stack, space):
+        paren = stack and stack[-1].text == '('
+        if paren: stack.pop()
+        if not stack: raise PreprocessorError("missing operand for 'defined'")
+        t = stack.pop()
+        if paren:
+            if not stack or stack.pop().text != ')':
+                raise PreprocessorError("missing ')' after 'defined'")
+        return Token('num', '1' if self.is_defined(t.text) else '0', space)
+
+    def is_defined(self, name):
+        return name in self.macros or name in builtin_specials
+
+    # Collect the arguments of a macro call from the token stack
+    def collect_args(self, stack):
+        saved = list(stack)
+        stack.pop() # '('
+        args, cur, depth = [], [], 0
+        while stack:
+            t = stack.pop()
+            if t.text == '(':
+                depth += 1
+            elif t.text == ')':
+                if depth == 0:
+                    args.append(cur)
+                    return args, t
+                depth -= 1
+            elif t.text == ',' and depth == 0:
+                args.append(cur)
+                cur = []
+                continue
+            cur.append(t)
+        stack[:] = saved
+        return None, None
+
+    def substitute(self, m, args, hide, in_if):
+        if args is not None:
+            params = m.params
+            if not params and args == [[]]: args = []
+            if m.variadic:
+                nfixed = len(params) - 1
+                args = args + [[]] * (len(params) - len(args))
+                va = []
+                for i, a in enumerate(args[nfixed:]):
+                    if i: va.append(Token('punct', ','))
+                    va += a
+                args = args[:nfixed] + [ va ]
+            elif len(args) != len(params):
+                raise PreprocessorError(f"macro '{m.name}' requires {len(params)} arguments, but {len(args)} given")
+
+        body, pindex, res, expanded = m.body, m.pindex, [], {}
+        placemarker = Token('pm', '')
+        i, n = 0, len(body)
+        while i < n:
+            t = body[i]
+            # Stringify a parameter
+            if args is not None and t.text in ('#', '%:') and i + 1 < n and body[i + 1].text in pindex:
+                res.append(Token('str', stringify(args[pindex[body[i + 1].text]]), t.space))
+                i += 2
+                continue
+            # Paste the previous token with the next one
+            if t.text in ('##', '%:%:') and res and i + 1 < n:
+                r = body[i + 1]
+                if r.text in pindex:
+                    rtoks = args[pindex[r.text]]
+                    # GNU comma elision for ', ## __VA_ARGS__'
+                    if not rtoks and m.variadic and pindex[r.text] == len(m.params) - 1 and res[-1].text == ',':
+                        res.pop()
+                        i += 2
+                        continue
+                else:
+                    rtoks = [ r ]
+                if rtoks:
+                    left = res.pop()
+                    if left is placemarker:
+                        res += rtoks
+                    else:
+                        pasted = tokenize(left.text + rtoks[0].text)
+                        if pasted: pasted[0].space = left.space
+                        res += pasted + rtoks[1:]
+                i += 2
+                continue
+            # Substitute a parameter with its argument
+            if args is not None and t.text in pindex:
+                idx = pindex[t.text]
+                if i + 1 < n and body[i + 1].text in ('##', '%:%:'):
+                    res += args[idx] or [ placemarker ]
+                else:
+                    if idx not in expanded: expanded[idx] = self.expand_arg(args[idx], in_if)
+                    arg = expanded[idx]
+                    if arg:
+                        res.append(arg[0].copy(space=t.space))
+                        res += arg[1:]
+                i += 1
+                continue
+            res.append(t)
+            i += 1
+
+        # Tokens are shared, so only new tokens get a new hide set
+        return [ x if hide <= x.hide else x.copy(hide=x.hide | hide) for x in res if x is not placemarker ]
+
+    #
+    # Evaluate an #if expression
+    #
+    def eval_if(self, text):
+        toks = self.expand(tokenize(text), in_if=True)
+        return compile_expr(toks, const_leaf, const_call)(None)
+
+    # Test an #if condition. One that can't be evaluated counts as false.
+    def test_if(self, text, path, line_number):
+        try:
+            return bool(self.eval_if(text))
+        except (PreprocessorError, ZeroDivisionError) as exc:
+            self.errors.append(f"{path}:{line_number}: {exc}")
+            return False
+
+    # Evaluate a single expanded argument as an expression
+    def eval_tokens(self, toks):
+        return compile_expr(self.expand(toks, in_if=True), const_leaf, const_call)(None)
+
+    def is_enabled(self, arg):
+        return detokenize(self.expand(arg)).replace(' ', '') in enabled_values
+
+    #
+    # Includes
+    #
+    def find_include(self, text, curdir, after=None):
+        text = text.strip()
+        if not (text.startswith('"') or text.startswith('<')):
+            text = detokenize(self.expand(tokenize(text))).strip()
+        if text.startswith('"') and text.endswith('"'):
+            name, dirs = text[1:-1], [ curdir ] + self.include_dirs
+        elif text.startswith('<') and text.endswith('>'):
+            name, dirs = text[1:-1].strip(), self.include_dirs
+        else:
+            raise PreprocessorError(f"#include expects \"FILENAME\" or <FILENAME>, got {text}")
+        # For #include_next skip to the search dirs after the current one
+        if after is not None:
+            found = [ i for i, d in enumerate(self.include_dirs) if Path(os.path.normpath(d)) == after ]
+            dirs = self.include_dirs[found[0] + 1:] if found else []
+        for d in dirs:
+            path = Path(os.path.normpath(d / name))
+            if path.is_file(): return path
+        return None
+
+    def has_include(self, args):
+        text = detokenize(sum(args, [])) if args else ''
+        try:
+            return int(self.find_include(text, self.curdir) is not None)
+        except PreprocessorError:
+            return 0
+
+    #
+    # Process a file, or some text as if it were a file
+    #
+    def include(self, path):
+        path = Path(path)
+        if path in self.pragma_once: return
+        self.process(path.read_text(encoding='utf-8', errors='replace'), path)
+
+    def process(self, text, path=Path('<stdin>')):
+        self.depth += 1
+        if self.depth > 200: raise PreprocessorError(f"#include nested too deeply in {path}")
+
+        text = text.replace('\\\r\n', '').replace('\\\n', '')
+        text = commgrep.sub(lambda m: ' ' if m[0][0] == '/' else m[0], text)
+
+        stack = []          # [ parent_active, any_taken, active ]
+        active = True
+        for line_number, line in enumerate(text.split('\n'), 1):
+            m = dirgrep.match(line)
+            if not m: continue
+            directive, rest = m[1], m[2].strip()
+            self.curdir = path.parent
+            try:
+                if directive in ('if', 'ifdef', 'ifndef'):
+                    if active:
+                        if directive == 'if': cond = self.test_if(rest, path, line_number)
+                        elif not rest: raise PreprocessorError(f"no macro name given in #{directive}")
+                        else: cond = self.is_defined(rest.split()[0]) == (directive == 'ifdef')
+                    else:
+                        cond = False
+                    stack.append([ active, cond, active and cond ])
+                    active = active and cond
+                elif directive in ('elif', 'else', 'endif'):
+                    if not stack: raise PreprocessorError(f"#{directive} without #if")
+                    if directive == 'endif':
+                        stack.pop()
+                    else:
+                        e = stack[-1]
+                        if not e[0] or e[1]:
+                            e[2] = False
+                        elif directive == 'else':
+                            e[1] = e[2] = True
+                        else:
+                            e[2] = self.test_if(rest, path, line_number)
+                            e[1] = e[2]
+                    active = stack[-1][2] if stack else True
+                elif not active:
+                    continue
+                elif directive == 'define':
+                    self.define_line(rest)
+                elif directive == 'undef':
+                    self.undef(rest.split()[0])
+                elif directive in ('include', 'include_next'):
+                    inc = self.find_include(rest, path.parent, path.parent if directive == 'include_next' else None)
+                    if inc is not None: self.include(inc)
+                elif directive == 'pragma':
+                    if rest == 'once': self.pragma_once.add(path)
+                elif directive == 'error':
+                    self.errors.append(f"{path}:{line_number}: #error {rest}")
+            except PreprocessorError as exc:
+                self.errors.append(f"{path}:{line_number}: {exc}")
+
+        self.depth -= 1
+
+#
+# Marlin option macros evaluated directly, without expanding macros.h
+#
+def _enabled(pp, args):  return int(all(pp.is_enabled(a) for a in args))
+def _disabled(pp, args): return int(not any(pp.is_enabled(a) for a in args))
+def _any(pp, args):      return int(any(pp.is_enabled(a) for a in args))
+def _count(pp, args):    return sum(pp.is_enabled(a) for a in args)
+
+def _pin_exists(pp, args):
+    pin = detokenize(args[0]).strip() + '_PIN'
+    return int(pin in pp.macros and pp.eval_tokens([ Token('id', pin) ]) >= 0)
+
+intrinsics = {
+    'ENABLED': _enabled, 'ALL': _enabled, 'BOTH': _enabled,
+    'DISABLED': _disabled, 'NONE': _disabled,
+    'ANY': _any, 'EITHER': _any,
+    'COUNT_ENABLED': _count,
+    'PIN_EXISTS': _pin_exists
+}
+
+#
+# Run the Python preprocessor the same way 'preprocessor.run_preprocessor' runs gcc.
+# 'cppdefines' is a list of NAME or (NAME, VALUE) items, as from env.ParseFlagsExtended.
+# 'builtins' is an optional dict of compiler builtin defines.
+#
+def run_preprocessor(cppdefines=(), fn=None, include_dirs=(), builtins=None):
+    filename = fn or 'buildroot/share/PlatformIO/scripts/common-dependencies.h'
+    pp = Preprocessor(include_dirs)
+    for key, value in (builtins or {}).items():
+        pp.define_line(f'{key} {value}')
+    for s in cppdefines:
+        if isinstance(s, tuple): pp.define(s[0], str(s[1]))
+        else: pp.define(s)
+    pp.define('__MARLIN_DEPS__')
+    pp.include(filename)
+    return pp
+
+# Parse 'gcc -dM' output lines into a define map, as load_marlin_features does
+def parse_define_lines(lines):
+    defines = {}
+    for line in lines:
+        if isinstance(line, bytes): line = line.decode()
+        feature = line[8:].strip().split(' ')
+        defines[feature[0]] = ' '.join(feature[1:])
+    return defines
+
+def compiler_defines(cxx, args=(), fn=os.devnull):
+    import subprocess
+    cmd = [ cxx ] + list(args) + [ '-w', '-dM', '-E', '-x', 'c++', fn ]
+    return parse_define_lines(subprocess.check_output(cmd).splitlines())
+
+# The compiler's own include search path, for system headers like <stdint.h>
+def compiler_include_dirs(cxx):
+    import subprocess
+    out = subprocess.run([ cxx, '-x', 'c++', '-E', '-v', os.devnull ], capture_output=True, text=True).stderr
+    dirs, insearch = [], False
+    for line in out.splitlines():
+        if line.startswith('#include <...> search starts here:'): insearch = True
+        elif line.startswith('End of search list.'): break
+        elif insearch: dirs.append(line.strip())
+    return dirs
+
+#
+# Compare the Python define map against the one from a real compiler
+#
+def cross_check(cxx, cppdefines=(), fn=None):
+    filename = fn or 'buildroot/share/PlatformIO/scripts/common-dependencies.h'
+    dargs = [ '-D' + (f'{s[0]}={s[1]}' if isinstance(s, tuple) else s) for s in cppdefines ]
+    gcc_map = compiler_defines(cxx, dargs + [ '-D__MARLIN_DEPS__' ], filename)
+    builtins = compiler_defines(cxx)
+    py_map = run_preprocessor(cppdefines, filename, compiler_include_dirs(cxx), builtins).define_map()
+    missing = sorted(set(gcc_map) - set(py_map))
+    extra = sorted(set(py_map) - set(gcc_map))
+    differ = sorted(k for k in set(gcc_map) & set(py_map) if gcc_map[k] != py_map[k])
+    return missing, extra, differ, gcc_map, py_map
+
+def main():
+    import sys, argparse
+    parser = argparse.ArgumentParser(description="Resolve Marlin features without a compiler")
+    parser.add_argument('-D', dest='defines', action='append', default=[], metavar='NAME[=VAL]')
+    parser.add_argument('-I', dest='include_dirs', action='append', default=[], metavar='DIR')
+    parser.add_argument('--builtins', help="File with the compiler's builtin defines (from 'g++ -dM -E -x c++ /dev/null')")
+    parser.add_argument('--cxx', help="Compiler to get builtin defines from, or to check against")
+    parser.add_argument('--check', action='store_true', help="Compare the result with the compiler given by --cxx")
+    parser.add_argument('--json', action='store_true', help="Print the define map as JSON")
+    parser.add_argument('file', nargs='?')
+    args = parser.parse_args()
+
+    cppdefines = [ tuple(d.split('=', 1)) if '=' in d else d for d in args.defines ]
+
+    if args.check:
+        if not args.cxx: parser.error("--check requires --cxx")
+        missing, extra, differ, gcc_map, py_map = cross_check(args.cxx, cppdefines, args.file)
+        for k in missing: print(f"Missing: {k} {gcc_map[k]}")
+        for k in extra: print(f"Extra:   {k} {py_map[k]}")
+        for k in differ: print(f"Differs: {k} gcc: '{gcc_map[k]}' python: '{py_map[k]}'")
+        print(f"{len(gcc_map)} defines, {len(missing)} missing, {len(extra)} extra, {len(differ)} different")
+        sys.exit(1 if missing or extra or differ else 0)
+
+    builtins, include_dirs = None, args.include_dirs
+    if args.builtins:
+        builtins = parse_define_lines(Path(args.builtins).read_text().splitlines())
+    elif args.cxx:
+        builtins = compiler_defines(args.cxx)
+        include_dirs += compiler_include_dirs(args.cxx)
+
+    pp = run_preprocessor(cppdefines, args.file, include_dirs, builtins)
+    for err in pp.errors: print(err, file=sys.stderr)
+
+    if args.json:
+        print(json.dumps(pp.define_map(), indent=2))
+    else:
+        for line in pp.define_lines(): print(line.decode())
+
+if __name__ == '__main__':
+    main()
@@ -5,16 +5,14 @@
 # Used by signature.py via common-dependencies.py to generate a schema file during the PlatformIO build.
 # This script can also be run standalone from within the Marlin repo to generate all schema files.
 #
-import re,json
+# With 'sqlite' it writes schema.db, an indexed SQLite database of the options.
+# With 'msgpack' it writes schema.msgpack, a compact binary form of schema.json.
+# With 'corpus' it indexes every config in a tree like config/examples instead:
+#   schema.py corpus [CONFIGS_DIR] [OUTFILE]
+#
+import re,json,hashlib,pickle
 from pathlib import Path
-
-def extend_dict(d:dict, k:tuple):
-    if len(k) >= 1 and k[0] not in d:
-        d[k[0]] = {}
-    if len(k) >= 2 and k[1] not in d[k[0]]:
-        d[k[0]][k[1]] = {}
-    if len(k) >= 3 and k[2] not in d[k[0]][k[1]]:
-        d[k[0]][k[1]][k[2]] = {}
+import serialize
 
 grouping_patterns = [
     re.compile(r'^([XYZIJKUVW]|[XYZ]2|Z[34]|E[0-7])$'),
@@ -25,84 +23,184 @@ grouping_patterns = [
     re.compile(r'^(HOTENDS|BED|PROBE|COOLER)$'),
     re.compile(r'^[XYZIJKUVW]M(IN|AX)$')
 ]
-# If the indexed part of the option name matches a pattern
-# then add it to the dictionary.
-def find_grouping(gdict, filekey, sectkey, optkey, pindex):
-    optparts = optkey.split('_')
-    if 1 < len(optparts) > pindex:
-        for patt in grouping_patterns:
-            if patt.match(optparts[pindex]):
-                subkey = optparts[pindex]
-                modkey = '_'.join(optparts)
-                optparts[pindex] = '*'
-                wildkey = '_'.join(optparts)
-                kkey = f'{filekey}|{sectkey}|{wildkey}'
-                if kkey not in gdict: gdict[kkey] = []
-                gdict[kkey].append((subkey, modkey))
-
-# Build a list of potential groups. Only those with multiple items will be grouped.
+# All the grouping patterns in one. A name part can only match one of them.
+group_part = re.compile('^(' + '|'.join(f'(?:{patt.pattern[1:-1]})' for patt in grouping_patterns) + ')$')
+
+#
+# Group options whose names differ only by one part, e.g., X_MIN_POS, Y_MIN_POS
+# and Z_MIN_POS become '*_MIN_POS': { 'X': {...}, 'Y': {...}, 'Z': {...} }.
+# Name parts are tried from the last (up to the 11th) to the first, so groups can
+# be grouped again, e.g., '*_*_ENDSTOP_INVERTING'. Only groups of two or more
+# options are made.
+#
+# Each name is split and its parts matched only once, and each option is put into
+# a list for every part that can be a wildcard, so each pass only looks at the
+# options that can be grouped on that part.
+#
 def group_options(schema):
-    for pindex in range(10, -1, -1):
-        found_groups = {}
-        for filekey, f in schema.items():
-            for sectkey, s in f.items():
-                for optkey in s:
-                    find_grouping(found_groups, filekey, sectkey, optkey, pindex)
-
-        fkeys = [ k for k in found_groups.keys() ]
-        for kkey in fkeys:
-            items = found_groups[kkey]
-            if len(items) > 1:
-                f, s, w = kkey.split('|')
-                extend_dict(schema, (f, s, w))                      # Add wildcard group to schema
-                for subkey, optkey in items:                        # Add all items to wildcard group
-                    schema[f][s][w][subkey] = schema[f][s][optkey]  # Move non-wildcard item to wildcard group
-                    del schema[f][s][optkey]
-            del found_groups[kkey]
-
-# Extract all board names from boards.h
-def load_boards():
-    bpath = Path("Marlin/src/core/boards.h")
-    if bpath.is_file():
+    part_ok = {}
+    def wild_indexes(parts):
+        if len(parts) < 2: return []
+        found = []
+        for i, part in enumerate(parts[:11]):
+            if part not in part_ok: part_ok[part] = bool(group_part.match(part))
+            if part_ok[part]: found.append(i)
+        return found
+
+    for f in schema.values():
+        for s in f.values():
+            candidates = [ [] for _ in range(11) ]
+            for optkey in s:
+                parts = optkey.split('_')
+                for i in wild_indexes(parts): candidates[i].append((optkey, parts))
+
+            for pindex in range(10, -1, -1):
+                found_groups = {}
+                for optkey, parts in candidates[pindex]:
+                    if optkey not in s: continue                    # Already moved into a group
+                    wild = parts[:pindex] + [ '*' ] + parts[pindex+1:]
+                    found_groups.setdefault('_'.join(wild), []).append((parts[pindex], optkey, wild))
+
+                for w, items in found_groups.items():
+                    if len(items) < 2: continue
+                    group = s.setdefault(w, {})                     # Add wildcard group to section
+                    for subkey, optkey, _ in items:                 # Move the items into the group
+                        group[subkey] = s.pop(optkey)
+                    wild = items[0][2]                              # The group may be grouped again
+                    for i in wild_indexes(wild):
+                        if i < pindex: candidates[i].append((w, wild))
+
+# Extract all board names from boards.h, kept by the file's full path and mtime
+# so that parsing many configs (e.g., extract_corpus) only reads it once
+boards_cache = {}
+def load_boards(bpath=Path("Marlin/src/core/boards.h")):
+    try:
+        key = (bpath.resolve(), bpath.stat().st_mtime_ns)
+    except OSError:
+        return ''
+    if key not in boards_cache:
         with bpath.open() as bfile:
             boards = []
             for line in bfile:
                 if line.startswith("#define BOARD_"):
                     bname = line.split()[1]
                     if bname != "BOARD_UNKNOWN": boards.append(bname)
-            return "['" + "','".join(boards) + "']"
-    return ''
+            boards_cache[key] = "['" + "','".join(boards) + "']"
+    return boards_cache[key]
+
+# Parsing states
+class Parse:
+    NORMAL          = 0 # No condition yet
+    BLOCK_COMMENT   = 1 # Looking for the end of the block comment
+    EOL_COMMENT     = 2 # EOL comment started, maybe add the next comment?
+    GET_SENSORS     = 3 # Gathering temperature sensor options
+    ERROR           = 9 # Syntax error
+
+# Regex for #define NAME [VALUE] [COMMENT] with sanitized line
+defgrep = re.compile(r'^(//)?\s*(#define)\s+([A-Za-z0-9_]+)\s*(.*?)\s*(//.+)?$')
+commented_define = re.compile(r'^//\s*#define')
+sensor_item = re.compile(r'^(-?\d+)\s*:\s*(.+)$')
+units_comment = re.compile(r'^\(([^)]+)\)')
+
+# Regexes to keep an expression as-is in a 'requires' condition
+atom_call = re.compile(r'^[A-Za-z0-9_]*(\([^)]+\))?$')
+atom_compare = re.compile(r'^[A-Za-z0-9_]+ == \d+?$')
+
+# Regexes to get the type of a #define from its value
+bool_value = re.compile(r'^(true|false)$')
+int_value = re.compile(r'^[-+]?\s*\d+$')
+float_value = re.compile(r'[-+]?\s*(\d+\.|\d*\.\d+)([eE][-+]?\d+)?[fF]?')
+state_value = re.compile(r'^(LOW|HIGH)$')
+enum_value = re.compile(r'^[A-Za-z0-9_]{3,}$')
+int_array_value = re.compile(r'^{(\s*[-+]?\s*\d+\s*(,\s*)?)+}$')
+float_array_value = re.compile(r'^{(\s*[-+]?\s*(\d+\.|\d*\.\d+)([eE][-+]?\d+)?[fF]?\s*(,\s*)?)+}$')
+
+def use_comment(c, opt, sec, bufref):
+    if c.startswith(':'):               # If the comment starts with : then it has magic JSON
+        d = c[1:].strip()               # Strip the leading :
+        cbr = c.rindex('}') if d.startswith('{') else c.rindex(']') if d.startswith('[') else 0
+        if cbr:
+            opt, cmt = c[1:cbr+1].strip(), c[cbr+1:].strip()
+            if cmt != '': bufref.append(cmt)
+        else:
+            opt = c[1:].strip()
+    elif c.startswith('@section'):      # Start a new section
+        sec = c[8:].strip()
+    elif not c.startswith('========'):
+        bufref.append(c)
+    return opt, sec
+
+# Parenthesize the given expression if needed
+def atomize(s):
+    if s == '' or atom_call.match(s) or atom_compare.match(s):
+        return s
+    return f'({s})'
+
+#
+# The schema is cached in .pio/build/marlin_schema.pickle, keyed by the contents
+# of the files it comes from, so it's only parsed again when one of them changes.
+# Pickle is used because it loads and saves several times faster than JSON.
+# Bump SCHEMA_VERSION whenever the parser output changes.
+#
+SCHEMA_VERSION = 2
+SCHEMA_CACHE = Path('.pio', 'build', 'marlin_schema.pickle')
+CONFIG_FILES = { 'Configuration.h':'basic', 'Configuration_adv.h':'advanced' }
+
+def schema_key(folder):
+    sha = hashlib.sha256(str(SCHEMA_VERSION).encode())
+    for fpath in [ Path(folder, fn) for fn in CONFIG_FILES ] + [ Path('Marlin/src/core/boards.h') ]:
+        try:
+            sha.update(fpath.read_bytes())
+        except OSError:
+            sha.update(b'-')
+    return sha.hexdigest()
 
 #
-# Extract a schema from the current configuration files
+# Extract a schema from the configuration files in a folder (Marlin by default),
+# using the cached schema if the files haven't changed.
+# Pass cache=None to always parse the files.
 #
-def extract():
+def extract(cache=SCHEMA_CACHE, folder='Marlin'):
+    if cache is None:
+        return parse_config(folder)
+
+    cache, key = Path(cache), schema_key(folder)
+    try:
+        entry = pickle.loads(cache.read_bytes())
+        if entry['key'] == key:
+            return entry['schema']
+    except:
+        pass
+
+    schema = parse_config(folder)
+    try:
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        cache.write_bytes(pickle.dumps({ 'key': key, 'schema': schema }, pickle.HIGHEST_PROTOCOL))
+    except OSError:
+        pass
+    return schema
+
+#
+# Parse the configuration files in a folder into a schema.
+# A folder with no Configuration_adv.h only gets the 'basic' options.
+#
+def parse_config(folder='Marlin'):
     # Load board names from boards.h
     boards = load_boards()
 
-    # Parsing states
-    class Parse:
-        NORMAL          = 0 # No condition yet
-        BLOCK_COMMENT   = 1 # Looking for the end of the block comment
-        EOL_COMMENT     = 2 # EOL comment started, maybe add the next comment?
-        GET_SENSORS     = 3 # Gathering temperature sensor options
-        ERROR           = 9 # Syntax error
-
     # List of files to process, with shorthand
-    filekey = { 'Configuration.h':'basic', 'Configuration_adv.h':'advanced' }
+    filekey = CONFIG_FILES
     # A JSON object to store the data
     sch_out = { 'basic':{}, 'advanced':{} }
-    # Regex for #define NAME [VALUE] [COMMENT] with sanitized line
-    defgrep = re.compile(r'^(//)?\s*(#define)\s+([A-Za-z0-9_]+)\s*(.*?)\s*(//.+)?$')
-    # Defines to ignore
-    ignore = ('CONFIGURATION_H_VERSION', 'CONFIGURATION_ADV_H_VERSION', 'CONFIG_EXAMPLES_DIR', 'CONFIG_EXPORT')
     # Start with unknown state
     state = Parse.NORMAL
     # Serial ID
     sid = 0
     # Loop through files and parse them line by line
     for fn, fk in filekey.items():
-        with Path("Marlin", fn).open() as fileobj:
+        fpath = Path(folder, fn)
+        if fn == 'Configuration_adv.h' and not fpath.is_file(): continue
+        with fpath.open() as fileobj:
             section = 'none'        # Current Settings section
             line_number = 0         # Counter for the line number of the file
             conditions = []         # Create a condition stack for the current file
@@ -130,8 +228,6 @@ def extract():
                 if join_line:
                     line = line[:-1].strip()
                     continue
-                else:
-                    line_end = line_number
 
                 defmatch = defgrep.match(line)
 
@@ -147,21 +243,6 @@ def extract():
                         comment_buff = []
                         state = Parse.NORMAL
 
-                def use_comment(c, opt, sec, bufref):
-                    if c.startswith(':'):               # If the comment starts with : then it has magic JSON
-                        d = c[1:].strip()               # Strip the leading :
-                        cbr = c.rindex('}') if d.startswith('{') else c.rindex(']') if d.startswith('[') else 0
-                        if cbr:
-                            opt, cmt = c[1:cbr+1].strip(), c[cbr+1:].strip()
-                            if cmt != '': bufref.append(cmt)
-                        else:
-                            opt = c[1:].strip()
-                    elif c.startswith('@section'):      # Start a new section
-                        sec = c[8:].strip()
-                    elif not c.startswith('========'):
-                        bufref.append(c)
-                    return opt, sec
-
                 # In a block comment, capture lines up to the end of the comment.
                 # Assume nothing follows the comment closure.
                 if state in (Parse.BLOCK_COMMENT, Parse.GET_SENSORS):
@@ -182,7 +263,7 @@ def extract():
 
                     # Collect temperature sensors
                     if state == Parse.GET_SENSORS:
-                        sens = re.match(r'^(-?\d+)\s*:\s*(.+)$', cline)
+                        sens = sensor_item.match(cline)
                         if sens:
                             s2 = sens[2].replace("'","''")
                             options_json += f"{sens[1]}:'{s2}', "
@@ -198,7 +279,7 @@ def extract():
                 # For the normal state we're looking for any non-blank line
                 elif state == Parse.NORMAL:
                     # Skip a commented define when evaluating comment opening
-                    st = 2 if re.match(r'^//\s*#define', line) else 0
+                    st = 2 if commented_define.match(line) else 0
                     cpos1 = line.find('/*')     # Start a block comment on the line?
                     cpos2 = line.find('//', st) # Start an end of line comment on the line?
 
@@ -238,14 +319,6 @@ def extract():
                         options_json = ''
                         continue
 
-                    # Parenthesize the given expression if needed
-                    def atomize(s):
-                        if s == '' \
-                        or re.match(r'^[A-Za-z0-9_]*(\([^)]+\))?$', s) \
-                        or re.match(r'^[A-Za-z0-9_]+ == \d+?$', s):
-                            return s
-                        return f'({s})'
-
                     #
                     # The conditions stack is an array containing condition-arrays.
                     # Each condition-array lists the conditions for the current block.
@@ -297,22 +370,22 @@ def extract():
                         # Type is based on the value
                         if val == '':
                             value_type = 'switch'
-                        elif re.match(r'^(true|false)$', val):
+                        elif bool_value.match(val):
                             value_type = 'bool'
                             val = val == 'true'
-                        elif re.match(r'^[-+]?\s*\d+$', val):
+                        elif int_value.match(val):
                             value_type = 'int'
                             val = int(val)
-                        elif re.match(r'[-+]?\s*(\d+\.|\d*\.\d+)([eE][-+]?\d+)?[fF]?', val):
+                        elif float_value.match(val):
                             value_type = 'float'
                             val = float(val.replace('f',''))
                         else:
                             value_type = 'string'   if val[0] == '"' \
                                     else 'char'     if val[0] == "'" \
-                                    else 'state'    if re.match(r'^(LOW|HIGH)$', val) \
-                                    else 'enum'     if re.match(r'^[A-Za-z0-9_]{3,}$', val) \
-                                    else 'int[]'    if re.match(r'^{(\s*[-+]?\s*\d+\s*(,\s*)?)+}$', val) \
-                                    else 'float[]'  if re.match(r'^{(\s*[-+]?\s*(\d+\.|\d*\.\d+)([eE][-+]?\d+)?[fF]?\s*(,\s*)?)+}$', val) \
+                                    else 'state'    if state_value.match(val) \
+                                    else 'enum'     if enum_value.match(val) \
+                                    else 'int[]'    if int_array_value.match(val) \
+                                    else 'float[]'  if float_array_value.match(val) \
                                     else 'array'    if val[0] == '{' \
                                     else ''
 
@@ -335,7 +408,7 @@ def extract():
                                 comment_buff = []
 
                             # If the comment specifies units, add that to the info
-                            units = re.match(r'^\(([^)]+)\)', full_comment)
+                            units = units_comment.match(full_comment)
                             if units:
                                 units = units[1]
                                 if units == 's' or units == 'sec': units = 'seconds'
@@ -356,6 +429,7 @@ def extract():
                             info = sch_out[fk][section][define_name]
                             if isinstance(info, dict): info = [ info ]  # Convert a single dict into a list
                             info.append(define_info)                    # Add to the list
+                            sch_out[fk][section][define_name] = info
                         else:
                             # Add the define dict with name as key
                             sch_out[fk][section][define_name] = define_info
@@ -365,16 +439,332 @@ def extract():
 
     return sch_out
 
+#
+# Index the enabled #defines in a schema (before grouping) by name, giving
+# the file, line and section of each. A define may be in the schema more
+# than once, e.g., in both branches of an #if/#else.
+#
+def define_index(schema:dict):
+    filename = { 'basic':'Configuration.h', 'advanced':'Configuration_adv.h' }
+    index = {}
+    for fk, sections in schema.items():
+        for section, defines in sections.items():
+            for name, info in defines.items():
+                for item in info if isinstance(info, list) else [ info ]:
+                    if item['enabled']:
+                        index.setdefault(name, []).append({ 'file': filename[fk], 'line': item['line'], 'section': section })
+    return index
+
+#
+# Evaluate the 'requires' of every option in a schema (before grouping) for a
+# configuration, e.g., to show which options apply while a config is edited.
+# Each expression is compiled once into a Python closure by the #if expression
+# compiler in pypreprocessor.py and cached for all later evaluations.
+#
+# A configuration is a dict of define name => value string, like MARLIN_FEATURES,
+# a header in marlin_config.json, or schema_defines(schema). Defines used in an
+# expression are evaluated as expressions themselves. An expression that can't
+# be evaluated counts as false, as in pypreprocessor.py. Expressions are tested
+# against the whole configuration, not just the lines above the option.
+#
+class RequiresContext:
+
+    def __init__(self, config:dict):
+        self.config = config
+        self.numbers = {}   # define name => integer value
+        self.results = {}   # expression => bool
+
+    # The value of a define, following a define that is the name of another define
+    def resolve(self, name, seen=()):
+        val = str(self.config[name]).strip()
+        if val in self.config and val not in seen + (name,):
+            return self.resolve(val, seen + (name,))
+        return val
+
+    def enabled(self, name):
+        from pypreprocessor import enabled_values
+        return name in self.config and self.resolve(name).replace(' ', '') in enabled_values
+
+    def number(self, name):
+        from pypreprocessor import PreprocessorError
+        if name not in self.config: return 0
+        if name not in self.numbers:
+            self.numbers[name] = None           # Catch a define that refers to itself
+            try:
+                self.numbers[name] = compile_expression(str(self.config[name]))(self)
+            except:
+                del self.numbers[name]          # Let a later lookup raise the real error
+                raise
+        if self.numbers[name] is None:
+            raise PreprocessorError(f"'{name}' refers to itself")
+        return self.numbers[name]
+
+    # Test a 'requires' expression, remembering the result for this config
+    def test(self, expr):
+        from pypreprocessor import PreprocessorError
+        if expr not in self.results:
+            try:
+                self.results[expr] = bool(compile_expression(expr)(self))
+            except (PreprocessorError, ZeroDivisionError):
+                self.results[expr] = False
+        return self.results[expr]
+
+def requires_leaf(t):
+    from pypreprocessor import const_leaf
+    if t.kind == 'id' and t.text not in ('true', 'false'):
+        name = t.text
+        return lambda c: c.number(name)
+    return const_leaf(t)
+
+def requires_call(name, args):
+    from pypreprocessor import detokenize, PreprocessorError
+
+    # Split the argument tokens on top-level commas into names
+    names, depth, start = [], 0, 0
+    for i, t in enumerate(args + [ None ]):
+        if t is None or (t.text == ',' and depth == 0):
+            names.append(detokenize(args[start:i]).strip())
+            start = i + 1
+        elif t.text == '(': depth += 1
+        elif t.text == ')': depth -= 1
+
+    if name == 'defined':
+        return lambda c: int(names[0] in c.config)
+    if name in ('ENABLED', 'ALL', 'BOTH'):
+        return lambda c: int(all(c.enabled(n) for n in names))
+    if name in ('DISABLED', 'NONE'):
+        return lambda c: int(not any(c.enabled(n) for n in names))
+    if name in ('ANY', 'EITHER'):
+        return lambda c: int(any(c.enabled(n) for n in names))
+    if name == 'COUNT_ENABLED':
+        return lambda c: sum(c.enabled(n) for n in names)
+    if name == 'PIN_EXISTS':
+        pin = names[0] + '_PIN'
+        return lambda c: int(pin in c.config and c.number(pin) >= 0)
+    raise PreprocessorError(f"function-like macro '{name}' is not known")
+
+requires_cache = {}
+
+# Compile an expression into a function of a RequiresContext
+def compile_expression(expr):
+    if expr not in requires_cache:
+        from pypreprocessor import tokenize, compile_expr, PreprocessorError
+        try:
+            requires_cache[expr] = compile_expr(tokenize(expr), requires_leaf, requires_call)
+        except PreprocessorError as exc:
+            def failed(c, exc=exc): raise exc
+            requires_cache[expr] = failed
+    return requires_cache[expr]
+
+# The define name => value string of the enabled options in a schema.
+# For an option enabled more than once the first one is used.
+def schema_defines(schema:dict):
+    defines = {}
+    for sections in schema.values():
+        for options in sections.values():
+            for name, info in options.items():
+                for item in info if isinstance(info, list) else [ info ]:
+                    if item['enabled'] and name not in defines:
+                        val = item.get('value', '')
+                        defines[name] = ('true' if val else 'false') if isinstance(val, bool) else str(val)
+    return defines
+
+# Get the options whose 'requires' are met by a configuration, as a dict of
+# name => True/False. An option is active if any instance of it is active.
+def active_options(schema:dict, config:dict):
+    ctx = RequiresContext(config)
+    active = {}
+    for sections in schema.values():
+        for options in sections.values():
+            for name, info in options.items():
+                for item in info if isinstance(info, list) else [ info ]:
+                    if not active.get(name):
+                        active[name] = 'requires' not in item or ctx.test(item['requires'])
+    return active
+
+#
+# Corpus mode: Index all the configs in a tree, e.g., config/examples from the
+# MarlinFirmware/Configurations repo. Every folder with a Configuration.h is a
+# config, parsed in its own process. The index lists each enabled option with
+# its distinct values and the configs that set each value:
+#
+#   { "configs": [ "Creality/Ender-3/BigTreeTech SKR Mini E3 3.0", ... ],
+#     "options": { "BAUDRATE": [ { "value": 115200, "configs": [ 0, 5, ... ] },
+#                                { "value": 250000, "configs": [ 1, 2, ... ] } ], ... },
+#     "errors": { "Some/Config": "no #if block at line 123" } }
+#
+# Configs are referenced by their index in "configs" to keep the file small.
+# A switch (a #define with no value) has the value true. An option enabled more
+# than once in a config (e.g., in both branches of an #if/#else) lists each value.
+#
+def config_values(folder):
+    try:
+        schema = parse_config(folder)
+    except Exception as exc:
+        return None, str(exc)
+    # Values are JSON types, so their JSON text is a unique key (keeping 1 and true apart)
+    values = {}
+    for sections in schema.values():
+        for defines in sections.values():
+            for name, info in defines.items():
+                for item in info if isinstance(info, list) else [ info ]:
+                    if item['enabled']:
+                        val = item.get('value', True)
+                        values.setdefault(name, {})[json.dumps(val)] = val
+    return values, None
+
+def extract_corpus(root, jobs=None):
+    from concurrent.futures import ProcessPoolExecutor
+
+    root = Path(root)
+    folders = sorted(set(p.parent for p in root.rglob('Configuration.h')))
+    configs = [ f.relative_to(root).as_posix() for f in folders ]
+
+    options, errors = {}, {}
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for i, (values, error) in enumerate(pool.map(config_values, folders, chunksize=8)):
+            if error:
+                errors[configs[i]] = error
+                continue
+            for name, vals in values.items():
+                entries = options.setdefault(name, {})
+                for key, val in vals.items():
+                    entries.setdefault(key, { 'value': val, 'configs': [] })['configs'].append(i)
+
+    return {
+        'configs': configs,
+        'options': { name: list(options[name].values()) for name in sorted(options) },
+        'errors': errors
+    }
+
+#
+# The schema exports. See serialize.py for the backends.
+#
 def dump_json(schema:dict, jpath:Path):
-    with jpath.open('w') as jfile:
-        json.dump(schema, jfile, ensure_ascii=False, indent=2)
+    serialize.dump_json(schema, jpath)
+
+def dump_msgpack(schema:dict, mpath:Path):
+    serialize.dump_msgpack(schema, mpath)
+
+#
+# Write a schema (before grouping) to an SQLite database, to find options by
+# name, section, or dependency without loading the whole schema. E.g.:
+#
+#   SELECT file, line, requires FROM options WHERE name = 'BLTOUCH'
+#   SELECT o.name FROM options o JOIN requires r ON r.option_id = o.id WHERE r.name = 'BLTOUCH'
+#
+# Tables:
+#   sections  id, file, name
+#   options   id (the schema 'sid'), name, section_id, file, line, enabled,
+#             type, value (as JSON), units, comment, requires, allowed (as written)
+#   requires  option_id, name - the names used in the option's 'requires'
+#   allowed   option_id, position, value, label - the parsed 'options' list
+#   info      key, value - e.g., 'schema_version'
+#
+SQL_TABLES = '''
+CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE sections (id INTEGER PRIMARY KEY, file TEXT NOT NULL, name TEXT NOT NULL, UNIQUE (file, name));
+CREATE TABLE options (
+  id INTEGER PRIMARY KEY, name TEXT NOT NULL, section_id INTEGER NOT NULL REFERENCES sections (id),
+  file TEXT NOT NULL, line INTEGER, enabled INTEGER NOT NULL, type TEXT, value TEXT,
+  units TEXT, comment TEXT, requires TEXT, allowed TEXT
+);
+CREATE TABLE requires (option_id INTEGER NOT NULL REFERENCES options (id), name TEXT NOT NULL);
+CREATE TABLE allowed (option_id INTEGER NOT NULL REFERENCES options (id), position INTEGER NOT NULL, value TEXT, label TEXT);
+CREATE INDEX options_name ON options (name);
+CREATE INDEX options_section ON options (section_id);
+CREATE INDEX sections_name ON sections (name);
+CREATE INDEX requires_option ON requires (option_id);
+CREATE INDEX requires_name ON requires (name);
+CREATE INDEX allowed_option ON allowed (option_id);
+'''
+
+# Names in a 'requires' expression, but not macros like ENABLED(...) or defined(...)
+requires_name = re.compile(r'\b([A-Za-z_]\w*)\b(?!\s*\()')
+
+# Strip quotes from an item in an 'options' list, where '' is an escaped '
+def unquote(item):
+    if len(item) > 1 and item[0] == item[-1] and item[0] in '\'"':
+        return item[1:-1].replace(item[0] * 2, item[0])
+    return item
+
+# Parse an 'options' list like "['A','B']", "[0, 1]", "{ 0:'Low', 1:'High' }"
+# or "[ -5:'MAX31865...', 1:'100k...' ]" into (value, label) pairs
+def allowed_values(text):
+    from features import split_items
+    text = text.strip()
+    if text[:1] not in '[{' or text[-1:] not in ']}': return []
+    values = []
+    for item in split_items(text[1:-1]):
+        if item[0] in '\'"':
+            end = item.find(item[0], 1)
+            while end > 0 and item[end + 1:end + 2] == item[0]: end = item.find(item[0], end + 2)
+            key, rest = item[:end + 1], item[end + 1:].strip()
+        else:
+            key, _, rest = item.partition(':')
+            rest = ':' + rest if _ else ''
+        label = unquote(rest[1:].strip()) if rest.startswith(':') else None
+        values.append((unquote(key.strip()), label))
+    return values
+
+def dump_sqlite(schema:dict, dbpath:Path):
+    import sqlite3
+    filename = { 'basic':'Configuration.h', 'advanced':'Configuration_adv.h' }
+
+    sections, options, requires, allowed = [], [], [], []
+    for fk, sects in schema.items():
+        for section, defines in sects.items():
+            section_id = len(sections) + 1
+            sections.append((section_id, filename.get(fk, fk), section))
+            for name, info in defines.items():
+                for item in info if isinstance(info, list) else [ info ]:
+                    oid = item['sid']
+                    value = json.dumps(item['value'], ensure_ascii=False) if 'value' in item else None
+                    options.append((oid, name, section_id, filename.get(fk, fk), item['line'], int(item['enabled']),
+                                    item.get('type'), value, item.get('units'), item.get('comment'),
+                                    item.get('requires'), item.get('options')))
+                    if 'requires' in item:
+                        requires += [ (oid, dep) for dep in dict.fromkeys(requires_name.findall(item['requires'])) ]
+                    if 'options' in item:
+                        allowed += [ (oid, i, v, l) for i, (v, l) in enumerate(allowed_values(item['options'])) ]
+
+    # Build the database aside and swap it in, so readers never see a partial file
+    dbpath = Path(dbpath)
+    tmppath = dbpath.with_name(dbpath.name + '.tmp')
+    tmppath.unlink(missing_ok=True)
+    db = sqlite3.connect(tmppath)
+    try:
+        with db:
+            db.executescript(SQL_TABLES)
+            db.execute('INSERT INTO info VALUES (?, ?)', ('schema_version', str(SCHEMA_VERSION)))
+            db.executemany('INSERT INTO sections VALUES (?, ?, ?)', sections)
+            db.executemany('INSERT INTO options VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', options)
+            db.executemany('INSERT INTO requires VALUES (?, ?)', requires)
+            db.executemany('INSERT INTO allowed VALUES (?, ?, ?, ?)', allowed)
+    finally:
+        db.close()
+    tmppath.replace(dbpath)
 
 def dump_yaml(schema:dict, ypath:Path):
-    import yaml
-    with ypath.open('w') as yfile:
-        yaml.dump(schema, yfile, default_flow_style=False, width=120, indent=2)
+    serialize.dump_yaml(schema, ypath)
 
 def main():
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'corpus':
+        root = Path(sys.argv[2] if len(sys.argv) > 2 else 'config/examples')
+        outfile = Path(sys.argv[3] if len(sys.argv) > 3 else 'schema_corpus.json')
+        if not root.is_dir():
+            print(f"Error: {root} is not a folder.")
+            return
+        print(f"Indexing configs in {root} ...")
+        corpus = extract_corpus(root)
+        serialize.dump_json(corpus, outfile, indent=0)
+        for config, error in corpus['errors'].items():
+            print(f"Error: {config}: {error}")
+        print(f"Indexed {len(corpus['options'])} options in {len(corpus['configs'])} configs to {outfile}")
+        return
+
     try:
         schema = extract()
     except Exception as exc:
@@ -384,7 +774,6 @@ def main():
     if schema:
 
         # Get the first command line argument
-        import sys
         if len(sys.argv) > 1:
             arg = sys.argv[1]
         else:
@@ -395,6 +784,16 @@ def main():
             print("Generating JSON ...")
             dump_json(schema, Path('schema.json'))
 
+        # MessagePack schema
+        if arg in ['msgpack']:
+            print("Generating MessagePack ...")
+            dump_msgpack(schema, Path('schema.msgpack'))
+
+        # SQLite database, before grouping
+        if arg in ['sqlite', 'db']:
+            print("Generating SQLite ...")
+            dump_sqlite(schema, Path('schema.db'))
+
         # JSON schema (wildcard names)
         if arg in ['group', 'jsons']:
             group_options(schema)
@@ -402,18 +801,6 @@ def main():
 
         # YAML
         if arg in ['some', 'yml', 'yaml']:
-            try:
-                import yaml
-            except ImportError:
-                print("Installing YAML module ...")
-                import subprocess
-                try:
-                    subprocess.run(['python3', '-m', 'pip', 'install', 'pyyaml'])
-                    import yaml
-                except:
-                    print("Failed to install YAML module")
-                    return
-
             print("Generating YML ...")
             dump_yaml(schema, Path('schema.yml'))
 
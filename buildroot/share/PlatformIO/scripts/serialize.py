@@ -0,0 +1,161 @@
+#
+# serialize.py
+# Write data as JSON, YAML or MessagePack without any extra packages,
+# as used by schema.py for the schema exports
+#
+# JSON uses orjson if it's installed, which is several times faster than json.
+# MessagePack is a compact binary form of JSON for other tools to load. It uses
+# the msgpack package if it's installed, or else a small packer of its own.
+# YAML is written a line at a time, so PyYAML isn't needed and the document
+# is never held in memory. It loads the same as PyYAML's output.
+#
+import re, json, struct
+from pathlib import Path
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+#
+# JSON
+#
+def json_bytes(data, indent=2):
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else 0)
+    if indent:
+        return json.dumps(data, ensure_ascii=False, indent=indent).encode()
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode()
+
+def dump_json(data, path, indent=2):
+    Path(path).write_bytes(json_bytes(data, indent))
+
+#
+# MessagePack
+#
+def pack_into(out, obj):
+    if obj is None:
+        out += b'\xc0'
+    elif obj is True:
+        out += b'\xc3'
+    elif obj is False:
+        out += b'\xc2'
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:         out.append(obj)
+        elif -0x20 <= obj < 0:      out.append(obj & 0xFF)
+        elif 0 < obj < 0x100:       out += struct.pack('>BB', 0xCC, obj)
+        elif 0 < obj < 0x10000:     out += struct.pack('>BH', 0xCD, obj)
+        elif 0 < obj < 0x100000000: out += struct.pack('>BI', 0xCE, obj)
+        elif 0 < obj:               out += struct.pack('>BQ', 0xCF, obj)
+        elif -0x80 <= obj:          out += struct.pack('>Bb', 0xD0, obj)
+        elif -0x8000 <= obj:        out += struct.pack('>Bh', 0xD1, obj)
+        elif -0x80000000 <= obj:    out += struct.pack('>Bi', 0xD2, obj)
+        else:                       out += struct.pack('>Bq', 0xD3, obj)
+    elif isinstance(obj, float):
+        out += struct.pack('>Bd', 0xCB, obj)
+    elif isinstance(obj, str):
+        raw = obj.encode()
+        n = len(raw)
+        if n < 0x20:       out.append(0xA0 | n)
+        elif n < 0x100:    out += struct.pack('>BB', 0xD9, n)
+        elif n < 0x10000:  out += struct.pack('>BH', 0xDA, n)
+        else:              out += struct.pack('>BI', 0xDB, n)
+        out += raw
+    elif isinstance(obj, (list, tuple)):
+        n = len(obj)
+        if n < 0x10:       out.append(0x90 | n)
+        elif n < 0x10000:  out += struct.pack('>BH', 0xDC, n)
+        else:              out += struct.pack('>BI', 0xDD, n)
+        for item in obj: pack_into(out, item)
+    elif isinstance(obj, dict):
+        n = len(obj)
+        if n < 0x10:       out.append(0x80 | n)
+        elif n < 0x10000:  out += struct.pack('>BH', 0xDE, n)
+        else:              out += struct.pack('>BI', 0xDF, n)
+        for key, val in obj.items():
+            pack_into(out, key)
+            pack_into(out, val)
+    else:
+        raise TypeError(f"can't pack {type(obj).__name__}")
+
+def msgpack_bytes(data):
+    if msgpack:
+        return msgpack.packb(data)
+    out = bytearray()
+    pack_into(out, data)
+    return bytes(out)
+
+def dump_msgpack(data, path):
+    Path(path).write_bytes(msgpack_bytes(data))
+
+#
+# YAML
+#
+# A string is written plain if it can't be mistaken for another type (in YAML 1.1
+# or 1.2), or else as a JSON string, which is also a YAML double-quoted string.
+#
+yaml_plain = re.compile(r'^[A-Za-z_][\w./-]*$')
+yaml_words = { 'y', 'n', 'yes', 'no', 'on', 'off', 'true', 'false', 'null' }
+yaml_unsafe = re.compile(r'[\x7f-\x9f\u2028\u2029\ufeff]')
+
+def yaml_scalar(val):
+    if val is None: return 'null'
+    if isinstance(val, bool): return 'true' if val else 'false'
+    if isinstance(val, int): return str(val)
+    if isinstance(val, float):
+        if val != val: return '.nan'
+        if val in (float('inf'), float('-inf')): return '.inf' if val > 0 else '-.inf'
+        text = repr(val)
+        # A YAML 1.1 float needs a '.' in it, e.g., '1.0e-05' not '1e-05'
+        return text if '.' in text else text.replace('e', '.0e')
+    text = str(val)
+    if yaml_plain.match(text) and text.lower() not in yaml_words:
+        return text
+    return yaml_unsafe.sub(lambda m: '\\u%04x' % ord(m[0]), json.dumps(text, ensure_ascii=False))
+
+# Yield the lines of a non-empty dict or list in block style, with sequences
+# inside a mapping not indented further, the same as PyYAML does it.
+def yaml_block(node, indent, sort_keys):
+    if isinstance(node, dict):
+        keys = node
+        if sort_keys:
+            try:
+                keys = sorted(node)
+            except TypeError:   # Keys of mixed types
+                pass
+        for key in keys:
+            val, line = node[key], indent + yaml_scalar(key) + ':'
+            if isinstance(val, (dict, list)) and val:
+                yield line
+                yield from yaml_block(val, indent + '  ' if isinstance(val, dict) else indent, sort_keys)
+            else:
+                yield line + ' ' + yaml_value(val)
+    else:
+        for val in node:
+            if isinstance(val, (dict, list)) and val:
+                lines = yaml_block(val, indent + '  ', sort_keys)
+                yield indent + '- ' + next(lines)[len(indent) + 2:]
+                yield from lines
+            else:
+                yield indent + '- ' + yaml_value(val)
+
+def yaml_value(val):
+    if isinstance(val, dict): return '{}'
+    if isinstance(val, list): return '[]'
+    return yaml_scalar(val)
+
+def yaml_lines(data, sort_keys=True):
+    if isinstance(data, (dict, list)) and data:
+        yield from yaml_block(data, '', sort_keys)
+    else:
+        yield yaml_value(data)
+
+def dump_yaml(data, path, sort_keys=True):
+    with Path(path).open('w', encoding='utf-8') as yfile:
+        for line in yaml_lines(data, sort_keys):
+            yfile.write(line + '\n')
@@ -1,7 +1,9 @@
 #
 # signature.py
 #
-import schema
+import schema, profiler
+from features import MarlinFeatures
+from carray import byte_lines, c_array, write_if_changed
 
 import subprocess,re,json,hashlib
 from datetime import datetime
@@ -36,12 +38,113 @@ def get_file_sha256sum(filepath):
     return sha256_hash.hexdigest()
 
 #
-# Compress a JSON file into a zip file
+# Codecs for the embedded 'mc.zip', selected with CONFIGURATION_EMBEDDING_CODEC.
 #
-import zipfile
-def compress_file(filepath, outpath):
-    with zipfile.ZipFile(outpath, 'w', compression=zipfile.ZIP_BZIP2, compresslevel=9) as zipf:
-        zipf.write(filepath, compress_type=zipfile.ZIP_BZIP2, compresslevel=9)
+# DEFLATE, BZIP2 (the default) and LZMA make a standard zip file. The zip is the
+# same for the same JSON, with the file at the top level as 'marlin_config.json'
+# (for mc-apply.py) and a fixed timestamp.
+#
+# HEATSHRINK makes a heatshrink stream with the same window and lookahead as
+# Marlin's decoder (see src/libs/heatshrink/heatshrink_config.h), after a header
+# of 'MCHS', window bits, and lookahead bits. It needs the heatshrink2 (or
+# heatshrink) Python package. Use mc-apply.py to extract it.
+#
+import zipfile, io
+
+HEATSHRINK_MAGIC = b'MCHS'
+HEATSHRINK_WINDOW, HEATSHRINK_LOOKAHEAD = 8, 4
+
+def import_heatshrink():
+    try:
+        import heatshrink2 as heatshrink
+    except ImportError:
+        import heatshrink
+    return heatshrink
+
+def zip_codec(method, level):
+    def compress(data, name):
+        info = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+        info.compress_type = method
+        info.external_attr = 0o644 << 16
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as zipf:
+            zipf.writestr(info, data, compresslevel=level)
+        return buffer.getvalue()
+    return compress
+
+def heatshrink_compress(data, name):
+    hs = import_heatshrink()
+    return HEATSHRINK_MAGIC + bytes([ HEATSHRINK_WINDOW, HEATSHRINK_LOOKAHEAD ]) \
+         + hs.encode(data, window_sz2=HEATSHRINK_WINDOW, lookahead_sz2=HEATSHRINK_LOOKAHEAD)
+
+CODECS = {
+    'DEFLATE': zip_codec(zipfile.ZIP_DEFLATED, 9),
+    'BZIP2': zip_codec(zipfile.ZIP_BZIP2, 9),
+    'LZMA': zip_codec(zipfile.ZIP_LZMA, None),
+    'HEATSHRINK': heatshrink_compress
+}
+DEFAULT_CODEC = 'BZIP2'
+
+# Get the codec to use, falling back to the default if it's unknown or unavailable
+def get_codec(name):
+    name = str(name or DEFAULT_CODEC).strip('"').upper()
+    if name not in CODECS:
+        print(f"Warning: Unknown CONFIGURATION_EMBEDDING_CODEC '{name}'. Using {DEFAULT_CODEC}.")
+        return DEFAULT_CODEC
+    if name == 'HEATSHRINK':
+        try:
+            import_heatshrink()
+        except ImportError:
+            print(f"Warning: HEATSHRINK requires 'pip install heatshrink2'. Using {DEFAULT_CODEC}.")
+            return DEFAULT_CODEC
+    return name
+
+#
+# With CONFIGURATION_EMBEDDING_DELTA only the options that differ from the stock
+# configuration are embedded. The stock options for each CONFIGURATION_H_VERSION
+# are kept in config-defaults/<version>.json (made with mc-defaults.py), which
+# mc-apply.py uses to restore the full configuration. Stock options that are
+# disabled in this build are listed under '__REMOVED'.
+#
+DEFAULTS_DIR = Path('buildroot/share/PlatformIO/config-defaults')
+
+def config_delta(data, version):
+    try:
+        defaults = json.loads((DEFAULTS_DIR / f'{version}.json').read_text())
+    except (OSError, ValueError):
+        print(f"Warning: No configuration defaults for version {version}. Embedding the full configuration.")
+        return data
+
+    delta, removed = {}, {}
+    for header, opts in data.items():
+        if header in defaults:
+            base = defaults[header]
+            delta[header] = { k: v for k, v in opts.items() if base.get(k) != v }
+            gone = sorted(set(base) - set(opts))
+            if gone: removed[header] = gone
+        else:
+            delta[header] = opts
+        if header == '__INITIAL_HASH':
+            delta['__DEFAULTS'] = version
+    if removed: delta['__REMOVED'] = removed
+    return delta
+
+#
+# Compress a JSON file into 'mc.zip' with the given codec
+#
+@profiler.timed('compress_file', 'signature')
+def compress_file(filepath, outpath, codec=DEFAULT_CODEC):
+    data = CODECS[codec](Path(filepath).read_bytes(), Path(filepath).name)
+    return write_if_changed(outpath, data)
+
+# The C header for the mc.zip data, included by M500-M504.cpp
+def mczip_header(zipdata):
+    return (
+          '#ifndef NO_CONFIGURATION_EMBEDDING_WARNING\n'
+        + '  #warning "Generated file \'mc.zip\' is embedded (Define NO_CONFIGURATION_EMBEDDING_WARNING to suppress this warning.)"\n'
+        + '#endif\n'
+        + c_array('const unsigned char mc_zip[] PROGMEM', byte_lines(zipdata))
+    ).encode()
 
 #
 # Compute the build signature. The idea is to extract all defines in the configuration headers
@@ -62,16 +165,25 @@ def compute_build_signature(env):
     for header in files_to_keep:
         hashes += get_file_sha256sum(header)[0:10]
 
+    # Other headers the preprocessor included (MARLIN_FEATURES_DEPS) can change
+    # which options are enabled, so their state must also match the last build.
+    # It's kept out of marlin_config.json so the embedded data is reproducible.
+    from preprocessor import dependency_stamp
+    deps_stamp = dependency_stamp(env)
+
     marlin_json = build_path / 'marlin_config.json'
     marlin_zip = build_path / 'mc.zip'
+    marlin_deps = build_path / 'marlin_config.deps'
 
     # Read existing config file
     try:
         with marlin_json.open() as infile:
             conf = json.load(infile)
-            if conf['__INITIAL_HASH'] == hashes:
+            if conf['__INITIAL_HASH'] == hashes and marlin_deps.read_text() == deps_stamp:
                 # Same configuration, skip recomputing the building signature
-                compress_file(marlin_json, marlin_zip)
+                # and only compress if mc.zip is gone
+                if not marlin_zip.exists():
+                    compress_file(marlin_json, marlin_zip, get_codec(conf.get('Configuration_adv.h', {}).get('CONFIGURATION_EMBEDDING_CODEC')))
                 return
     except:
         pass
@@ -80,20 +192,10 @@ def compute_build_signature(env):
     from preprocessor import run_preprocessor
     complete_cfg = run_preprocessor(env)
 
-    # Dumb #define extraction from the configuration files
-    conf_defines = {}
-    all_defines = []
-    for header in files_to_keep:
-        defines = extract_defines(header)
-        # To filter only the define we want
-        all_defines += defines
-        # To remember from which file it cames from
-        conf_defines[header.split('/')[-1]] = defines
-
     r = re.compile(r"\(+(\s*-*\s*_.*)\)+")
 
     # First step is to collect all valid macros
-    defines = {}
+    defines = MarlinFeatures()
     for line in complete_cfg:
 
         # Split the define from the value
@@ -119,6 +221,27 @@ def compute_build_signature(env):
     if not ('CONFIGURATION_EMBEDDING' in defines or 'CONFIG_EXPORT' in defines):
         return
 
+    #
+    # Parse the configuration files once into a schema (or use the cached schema),
+    # shared by all exports, and index the enabled #defines to get the file(s) each one came from.
+    # If the schema can't be parsed fall back to a dumb #define extraction.
+    #
+    try:
+        with profiler.span('schema.extract', 'schema'):
+            conf_schema = schema.extract(Path(env['PROJECT_BUILD_DIR'], 'marlin_schema.pickle'))
+        define_files = { key: list(dict.fromkeys(item['file'] for item in where)) for key, where in schema.define_index(conf_schema).items() }
+    except Exception as exc:
+        print("Error: " + str(exc))
+        conf_schema = None
+        define_files = {}
+        for header in files_to_keep:
+            for key in extract_defines(header):
+                files = define_files.setdefault(key, [])
+                if header.split('/')[-1] not in files: files.append(header.split('/')[-1])
+
+    # Keys that are in the #define list in the Configuration files
+    all_defines = set(define_files) | { 'DETAILED_BUILD_VERSION', 'STRING_DISTRIBUTION_DATE' }
+
     # Second step is to filter useless macro
     resolved_defines = {}
     for key in defines:
@@ -132,7 +255,7 @@ def compute_build_signature(env):
         if key.endswith("_T_DECLARED"):
             continue
         # Remove keys that are not in the #define list in the Configuration list
-        if key not in all_defines + [ 'DETAILED_BUILD_VERSION', 'STRING_DISTRIBUTION_DATE' ]:
+        if key not in all_defines:
             continue
 
         # Don't be that smart guy here
@@ -143,23 +266,15 @@ def compute_build_signature(env):
     data = {}
     data['__INITIAL_HASH'] = hashes
     # First create a key for each header here
-    for header in conf_defines:
-        data[header] = {}
+    for header in files_to_keep:
+        data[header.split('/')[-1]] = {}
 
-    # Then populate the object where each key is going to (that's a O(N^2) algorithm here...)
+    # Then populate the object where each key is going to
     for key in resolved_defines:
-        for header in conf_defines:
-            if key in conf_defines[header]:
-                data[header][key] = resolved_defines[key]
-
-    # Every python needs this toy
-    def tryint(key):
-        try:
-            return int(defines[key])
-        except:
-            return 0
+        for header in define_files.get(key, ()):
+            data[header][key] = resolved_defines[key]
 
-    config_dump = tryint('CONFIG_EXPORT')
+    config_dump = defines.value('CONFIG_EXPORT', 0, int)
 
     #
     # Produce an INI file if CONFIG_EXPORT == 2
@@ -199,12 +314,6 @@ def compute_build_signature(env):
     # Produce a schema.json file if CONFIG_EXPORT == 3
     #
     if config_dump >= 3:
-        try:
-            conf_schema = schema.extract()
-        except Exception as exc:
-            print("Error: " + str(exc))
-            conf_schema = None
-
         if conf_schema:
             #
             # Produce a schema.json file if CONFIG_EXPORT == 3
@@ -221,16 +330,22 @@ def compute_build_signature(env):
             #
             elif config_dump == 4:
                 print("Generating schema.yml ...")
-                try:
-                    import yaml
-                except ImportError:
-                    env.Execute(env.VerboseAction(
-                        '$PYTHONEXE -m pip install "pyyaml"',
-                        "Installing YAML for schema.yml export",
-                    ))
-                    import yaml
                 schema.dump_yaml(conf_schema, build_path / 'schema.yml')
 
+            #
+            # Produce a schema.db SQLite database if CONFIG_EXPORT == 5
+            #
+            elif config_dump == 5:
+                print("Generating schema.db ...")
+                schema.dump_sqlite(conf_schema, build_path / 'schema.db')
+
+            #
+            # Produce a schema.msgpack file if CONFIG_EXPORT == 6
+            #
+            elif config_dump == 6:
+                print("Generating schema.msgpack ...")
+                schema.dump_msgpack(conf_schema, build_path / 'schema.msgpack')
+
     # Append the source code version and date
     data['VERSION'] = {}
     data['VERSION']['DETAILED_BUILD_VERSION'] = resolved_defines['DETAILED_BUILD_VERSION']
@@ -245,8 +360,10 @@ def compute_build_signature(env):
     # Produce a JSON file for CONFIGURATION_EMBEDDING or CONFIG_EXPORT == 1
     #
     if config_dump == 1 or 'CONFIGURATION_EMBEDDING' in defines:
-        with marlin_json.open('w') as outfile:
-            json.dump(data, outfile, separators=(',', ':'))
+        if 'CONFIGURATION_EMBEDDING_DELTA' in defines:
+            data = config_delta(data, defines['CONFIGURATION_H_VERSION'])
+        write_if_changed(marlin_json, json.dumps(data, separators=(',', ':')).encode())
+        marlin_deps.write_text(deps_stamp)
 
     #
     # The rest only applies to CONFIGURATION_EMBEDDING
@@ -255,22 +372,9 @@ def compute_build_signature(env):
         return
 
     # Compress the JSON file as much as we can
-    compress_file(marlin_json, marlin_zip)
+    compress_file(marlin_json, marlin_zip, get_codec(defines.get('CONFIGURATION_EMBEDDING_CODEC')))
 
     # Generate a C source file for storing this array
-    with open('Marlin/src/mczip.h','wb') as result_file:
-        result_file.write(
-              b'#ifndef NO_CONFIGURATION_EMBEDDING_WARNING\n'
-            + b'  #warning "Generated file \'mc.zip\' is embedded (Define NO_CONFIGURATION_EMBEDDING_WARNING to suppress this warning.)"\n'
-            + b'#endif\n'
-            + b'const unsigned char mc_zip[] PROGMEM = {\n '
-        )
-        count = 0
-        for b in (build_path / 'mc.zip').open('rb').read():
-            result_file.write(b' 0x%02X,' % b)
-            count += 1
-            if count % 16 == 0:
-                result_file.write(b'\n ')
-        if count % 16:
-            result_file.write(b'\n')
-        result_file.write(b'};\n')
+    # Leave the header alone if it's the same, to avoid a needless rebuild
+    with marlin_zip.open('rb') as zipdata:
+        write_if_changed('Marlin/src/mczip.h', mczip_header(zipdata))
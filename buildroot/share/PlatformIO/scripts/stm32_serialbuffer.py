@@ -25,7 +25,7 @@ if pioutil.is_pio_build():
         internal = int(getInternalSize(side) or default)
         flag = side + "_BUFFER_SIZE"
         # Return the largest value
-        return max(int(mf[flag]), internal) if flag in mf else internal
+        return max(mf.value(flag, internal, int), internal)
 
     # Add a build flag if it's not already defined
     def tryAddFlag(name, value):
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+#
+# test_schema.py
+# Tests of the schema parser, as used by signature.py for marlin_config.json
+#
+# Run from the Marlin root folder:
+#   python3 -m unittest discover -s buildroot/share/PlatformIO/scripts -p 'test_*.py'
+#
+import unittest, tempfile
+from pathlib import Path
+import schema
+
+CONFIG_H = '''
+// @section fans
+
+//#define FAN_SPEED 100  // Define here to override the default below
+#ifndef FAN_SPEED
+  #if ENABLED(FAST_FAN)
+    #define FAN_SPEED 200
+  #else
+    #define FAN_SPEED 50
+  #endif
+#endif
+
+#define OTHER_OPTION 1
+'''
+
+class TestRepeatedDefines(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        Path(self.tmp.name, 'Configuration.h').write_text(CONFIG_H)
+        self.schema = schema.parse_config(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    # Every instance of a define is kept, not just the first two
+    def test_all_instances_kept(self):
+        info = self.schema['basic']['fans']['FAN_SPEED']
+        self.assertIsInstance(info, list)
+        self.assertEqual([ item['enabled'] for item in info ], [ False, True, True ])
+
+    # A define disabled earlier in a section and enabled later gets a file for
+    # marlin_config.json, which only keeps defines found in define_index
+    def test_enabled_later_is_indexed(self):
+        index = schema.define_index(self.schema)
+        self.assertIn('FAN_SPEED', index)
+        self.assertEqual({ item['file'] for item in index['FAN_SPEED'] }, { 'Configuration.h' })
+        self.assertEqual(len(index['FAN_SPEED']), 2)
+        self.assertIn('OTHER_OPTION', index)
+
+    def test_schema_defines(self):
+        self.assertEqual(schema.schema_defines(self.schema)['FAN_SPEED'], '200')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -22,35 +22,26 @@
 
 # Generate Marlin TFT Images from bitmaps/PNG/JPG
 
-import sys,struct
+import sys
+from array import array
+from pathlib import Path
 from PIL import Image
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'PlatformIO' / 'scripts'))
+from carray import uint16_lines, c_array, write_if_changed
+
 def image2bin(image, output_file):
+    # Convert all pixels to RGB565 at once
+    width, height = image.size
+    rgb = image.convert('RGB').tobytes()
+    pixels = array('H', [ ((R >> 3) << 11) | ((G >> 2) << 5) | (B >> 3) for R, G, B in zip(rgb[0::3], rgb[1::3], rgb[2::3]) ])
     if output_file.endswith(('.c', '.cpp')):
-        f = open(output_file, 'wt')
-        is_cpp = True
-        f.write("const uint16_t image[%d] = {\n" % (image.size[1] * image.size[0]))
+        # One line per row of pixels
+        write_if_changed(output_file, c_array('const uint16_t image[%d]' % (width * height), uint16_lines(pixels, width, '')))
     else:
-        f = open(output_file, 'wb')
-        is_cpp = False
-    pixs = image.load()
-    for y in range(image.size[1]):
-        for x in range(image.size[0]):
-            R = pixs[x, y][0] >> 3
-            G = pixs[x, y][1] >> 2
-            B = pixs[x, y][2] >> 3
-            rgb = (R << 11) | (G << 5) | B
-            if is_cpp:
-                strHex = '0x{0:04X}, '.format(rgb)
-                f.write(strHex)
-            else:
-                f.write(struct.pack("B", (rgb & 0xFF)))
-                f.write(struct.pack("B", (rgb >> 8) & 0xFF))
-        if is_cpp:
-            f.write("\n")
-    if is_cpp:
-        f.write("};\n")
-    f.close()
+        # Raw little-endian pixels
+        if sys.byteorder == 'big': pixels.byteswap()
+        write_if_changed(output_file, pixels.tobytes())
 
 if len(sys.argv) <= 2:
     print("Utility to export a image in Marlin TFT friendly format.")